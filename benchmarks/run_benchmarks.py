@@ -0,0 +1,237 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+from argparse import ArgumentParser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'src')
+sys.path.insert(0, SRC_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from synthetic_repo import generate_repo, generate_samples
+from preprocess import projectParser, get_pkg_dir
+from context_graph import load_context_graph
+from extract_dataflow import PythonParser, ParseCache
+from graph import tGraph
+from tokenizer import ModelTokenizer
+from generator import Generator
+from profiler import stageProfiler
+from utils import MAX_HOP, ONLY_DEF, ENABLE_DOCSTRING, LAST_K_LINES
+
+
+class localEncoding(object):
+    '''
+    Stand-in for a tiktoken encoding: words, single symbols and whitespace runs are tokens,
+    whose ids are assigned when they are seen for the first time
+    '''
+    PATTERN = re.compile(r'\w+|[^\w\s]|\s+')
+
+    def __init__(self):
+        self.ids = {}
+        self.pieces = []
+
+
+    def encode(self, text, disallowed_special=()):
+        ret = []
+        for piece in self.PATTERN.findall(text):
+            idx = self.ids.get(piece, None)
+            if idx is None:
+                idx = len(self.pieces)
+                self.ids[piece] = idx
+                self.pieces.append(piece)
+            ret.append(idx)
+        return ret
+
+
+    def decode(self, tokens):
+        return ''.join([self.pieces[x] for x in tokens])
+
+
+class localTokenizer(ModelTokenizer):
+    '''
+    ModelTokenizer of gpt35 with localEncoding, no download is needed
+    '''
+    def __init__(self, snippet_cache_size=65536):
+        super().__init__('gpt35', snippet_cache_size)
+
+
+    def _set_tokenizer(self):
+        self.tokenizer = localEncoding()
+        self.task_desc = 'You are a Python expert. Please complete the last line of the following Python code:\n'
+        self.max_input_length = self.config.gpt35_max_token - self.config.max_to_generate - 16
+
+
+def bench_preprocess(profiler, pkg_dir, graph_file, repeat):
+    info = None
+    for _ in range(repeat):
+        project_parser = projectParser()
+        with profiler.span('parse_dir'):
+            info = project_parser.parse_dir(pkg_dir)
+
+    with open(graph_file, 'w') as f:
+        json.dump(info, f)
+
+    for _ in range(repeat):
+        with profiler.span('graph_load'):
+            load_context_graph(graph_file)
+
+    profiler.count('modules', len(info))
+    profiler.count('graph_bytes', os.path.getsize(graph_file))
+
+
+def bench_dataflow(profiler, samples):
+    parser = PythonParser()
+    for item in samples:
+        with profiler.span('dfg_parse'):
+            parser.parse(item['input'])
+
+    # successive completions in the same file, with the prefix-aware cache
+    caches = {}
+    for item in sorted(samples, key=lambda x:(x['fpath'], len(x['input']))):
+        cache = caches.setdefault(item['fpath'], ParseCache())
+        with profiler.span('dfg_parse_cached'):
+            parser.parse(item['input'], cache)
+
+
+def bench_traversal(profiler, generator, samples, repo_dir):
+    '''
+    tGraph construction and traversals of _retrieve_prompt, and projectSearcher.get_prompt of the cross-file imports
+    '''
+    parser = PythonParser()
+    for item in samples:
+        fpath = os.path.join(repo_dir, item['fpath'])
+        generator.set_pyfile(item['pkg'], fpath)
+        module = generator._get_module_name(fpath)
+        parser.parse(item['input'])
+
+        with profiler.span('tgraph_build'):
+            graph = tGraph(parser.DFG)
+
+        cross_import_nodes = set()
+        imported_info = []
+        for k, v in graph.node_dict.items():
+            if v.node_type == 'import' and generator.is_local_import(module, (v.module, v.name)) is not None:
+                cross_import_nodes.add(k)
+                imported_info.append((v.module, v.name))
+
+        with profiler.span('tgraph_traversal'):
+            variable_nodes = graph.get_last_k_lines(LAST_K_LINES)
+            proj_nodes, related_nodes, other_proj_nodes, other_related_nodes = graph.get_import_related_nodes(variable_nodes, cross_import_nodes, limit_assign=True)
+            graph.get_assign_subgraph(related_nodes, proj_nodes)
+            graph.get_assign_subgraph(other_related_nodes, other_proj_nodes)
+
+        node_list = generator.get_cross_file_nodes(module, imported_info)
+        with profiler.span('get_prompt'):
+            generator.searcher.get_prompt(node_list, MAX_HOP, ONLY_DEF, ENABLE_DOCSTRING)
+
+        profiler.count('nodes', len(graph.node_dict))
+        profiler.count('cross_imports', len(cross_import_nodes))
+
+
+def bench_retrieval(profiler, repo_dir, graph_dir, samples):
+    generator = Generator(repo_dir, graph_dir, 'gpt35', tokenizer=localTokenizer())
+    generator.profiler = stageProfiler(True)
+    for item in samples:
+        fpath = os.path.join(repo_dir, item['fpath'])
+        with profiler.span('retrieve_prompt'):
+            generator.retrieve_prompt(item['pkg'], fpath, item['input'])
+
+    # stages of retrieve_prompt
+    summary = generator.profiler.summary()
+    for stage, values in generator.profiler.durations.items():
+        if stage != 'total':
+            profiler.durations[f'retrieve_prompt.{stage}'] = list(values)
+    for counter, num in summary['counters'].items():
+        profiler.count(f'retrieve_prompt.{counter}', num)
+
+    generator.profiler = stageProfiler(False)
+    return generator
+
+
+def compare(results, baseline, threshold):
+    '''
+    Return: stages whose p50 is threshold times slower than in baseline
+    '''
+    regressions = []
+    print(f'{"stage":40s} {"baseline p50":>14s} {"p50":>14s} {"ratio":>8s}')
+    for stage, stats in results['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+        base_p50 = baseline['stages'][stage]['p50']
+        ratio = stats['p50'] / base_p50 if base_p50 > 0 else float('inf')
+        print(f'{stage:40s} {base_p50 * 1000:12.3f}ms {stats["p50"] * 1000:12.3f}ms {ratio:8.2f}')
+        if ratio > threshold:
+            regressions.append(stage)
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument('-o', '--out', required=True, help='json file of the results')
+    parser.add_argument('--modules', type=int, default=100, help='number of modules')
+    parser.add_argument('--classes', type=int, default=2, help='classes per module')
+    parser.add_argument('--methods', type=int, default=3, help='methods per class')
+    parser.add_argument('--fanout', type=int, default=5, help='modules imported by each module')
+    parser.add_argument('--lines', type=int, default=150, help='minimum lines per module')
+    parser.add_argument('--samples', type=int, default=100, help='number of completion samples')
+    parser.add_argument('--repeat', type=int, default=3, help='repeats of preprocessing and graph loading')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work_dir', default=None, help='directory of the synthetic repository and graph (temporary by default)')
+    parser.add_argument('--compare', default=None, help='results of a previous run, regressions are reported')
+    parser.add_argument('--threshold', type=float, default=1.2, help='p50 ratio over the previous run that counts as a regression')
+    args = parser.parse_args()
+
+    out_file = os.path.abspath(args.out)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='draco_bench_')
+    work_dir = os.path.abspath(work_dir)
+    repo_dir = os.path.join(work_dir, 'repos')
+    graph_dir = os.path.join(work_dir, 'graphs')
+    os.makedirs(graph_dir, exist_ok=True)
+
+    # ModelTokenizer reads config.yaml in the working directory
+    os.chdir(SRC_DIR)
+
+    pkg = 'synth'
+    start_time = time.time()
+    fpaths = generate_repo(repo_dir, pkg, args.modules, args.classes, args.methods, args.fanout, args.lines, seed=args.seed)
+    samples = generate_samples(repo_dir, pkg, fpaths, args.samples, seed=args.seed)
+    print(f'Generate {len(fpaths)} modules and {len(samples)} samples in {time.time() - start_time:.2f}s.')
+
+    profiler = stageProfiler(True)
+    bench_preprocess(profiler, get_pkg_dir(os.path.join(repo_dir, pkg)), os.path.join(graph_dir, f'{pkg}.json'), args.repeat)
+    bench_dataflow(profiler, samples)
+    generator = bench_retrieval(profiler, repo_dir, graph_dir, samples)
+    bench_traversal(profiler, generator, samples, repo_dir)
+
+    results = {
+        "config": {k: v for k, v in vars(args).items() if k not in ['out', 'work_dir', 'compare', 'threshold']},
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime('%Y-%m-%d %H:%M:%S')
+        }
+    }
+    results.update(profiler.summary())
+    with open(out_file, 'w') as f:
+        json.dump(results, f, indent=4)
+
+    for stage, stats in results['stages'].items():
+        print(f'{stage:40s} n={stats["count"]:<6d} p50={stats["p50"] * 1000:.3f}ms p95={stats["p95"] * 1000:.3f}ms p99={stats["p99"] * 1000:.3f}ms')
+    print(f'Results are saved to {out_file}')
+
+    if args.work_dir is None:
+        shutil.rmtree(work_dir)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'Regressions: {", ".join(regressions)}')
+            exit(1)
@@ -0,0 +1,177 @@
+import os
+import random
+from argparse import ArgumentParser
+
+
+'''
+Synthetic Python repositories for benchmarks
+
+Layout: root/pkg/pkg-1.0/pkg/sub{k}/mod{i}.py, like the repositories of ReccEval
+Each module imports names from `fanout` other modules, defines classes (with methods) and functions
+using the imported names, and is padded with more functions up to `lines` lines
+'''
+
+
+def _module_path(i, modules_per_pkg):
+    return f'sub{i // modules_per_pkg}', f'mod{i}'
+
+
+def _gen_imports(rnd, i, modules, fanout, modules_per_pkg):
+    '''
+    Return: import lines, and [(alias, kind)] of the imported names, kind is 'class', 'func' or 'module'
+    '''
+    lines = []
+    names = []
+    sub, _ = _module_path(i, modules_per_pkg)
+    others = [x for x in range(modules) if x != i]
+    for j in sorted(rnd.sample(others, min(fanout, len(others)))):
+        other_sub, other_mod = _module_path(j, modules_per_pkg)
+        choice = rnd.random()
+        if choice < 0.4:
+            # relative import in the same sub-package, absolute otherwise
+            if other_sub == sub:
+                lines.append(f'from .{other_mod} import C{j}_0, f{j}_0')
+            else:
+                lines.append(f'from pkg_name.{other_sub}.{other_mod} import C{j}_0, f{j}_0')
+            names += [(f'C{j}_0', 'class'), (f'f{j}_0', 'func')]
+        elif choice < 0.7:
+            lines.append(f'from pkg_name.{other_sub}.{other_mod} import C{j}_0 as Alias{j}')
+            names.append((f'Alias{j}', 'class'))
+        else:
+            lines.append(f'import pkg_name.{other_sub}.{other_mod} as m{j}')
+            names.append((f'm{j}', 'module'))
+
+    return lines, names
+
+
+def _use(rnd, names, j):
+    '''
+    An expression that uses one of the imported names
+    '''
+    if not names:
+        return f'{j}'
+    alias, kind = rnd.choice(names)
+    if kind == 'class':
+        return f'{alias}({j}).method_0({j})'
+    elif kind == 'func':
+        return f'{alias}({j}, {j + 1})'
+    else:
+        idx = alias[1:]
+        return f'{alias}.f{idx}_0({j}, {j + 1})'
+
+
+def _gen_function(rnd, name, names, indent, body_lines, is_method=False):
+    pad = ' ' * indent
+    args = 'self, a, b=None' if is_method else 'a, b=None'
+    hint = ''
+    if names and rnd.random() < 0.5:
+        class_names = [x for x, kind in names if kind == 'class']
+        if class_names:
+            hint = f' -> {rnd.choice(class_names)}'
+
+    lines = [f'{pad}def {name}({args}){hint}:',
+             f'{pad}    """Synthetic function {name}."""',
+             f'{pad}    result = a']
+    for j in range(body_lines):
+        choice = rnd.random()
+        if choice < 0.4:
+            lines.append(f'{pad}    value_{j} = {_use(rnd, names, j)}')
+            lines.append(f'{pad}    result = value_{j}')
+        elif choice < 0.6:
+            lines.append(f'{pad}    for item_{j} in range({j + 2}):')
+            lines.append(f'{pad}        result = item_{j} + {j}')
+        elif choice < 0.8 and is_method:
+            lines.append(f'{pad}    self.attr_{j % 3} = result')
+        else:
+            lines.append(f'{pad}    if result is None:')
+            lines.append(f'{pad}        result = {_use(rnd, names, j)}')
+    lines.append(f'{pad}    return result')
+    lines.append('')
+    return lines
+
+
+def gen_module(rnd, i, modules, classes, methods, fanout, lines, modules_per_pkg, pkg):
+    import_lines, names = _gen_imports(rnd, i, modules, fanout, modules_per_pkg)
+    src = [f'"""Synthetic module {i}."""', 'import os', 'from typing import List, Optional'] + import_lines + ['']
+    for j in range(min(3, len(names))):
+        src.append(f'CONST_{i}_{j} = {_use(rnd, names, j)}')
+    src.append('')
+
+    # f{i}_0 and C{i}_0 (with method_0) are imported by other modules
+    src += _gen_function(rnd, f'f{i}_0', names, 0, 3)
+    for c in range(max(1, classes)):
+        class_names = [x for x, kind in names if kind == 'class']
+        base = f'({rnd.choice(class_names)})' if class_names and rnd.random() < 0.3 else ''
+        src += [f'class C{i}_{c}{base}:', f'    """Synthetic class C{i}_{c}."""', f'    count: int = {c}', '']
+        src += ['    def __init__(self, a, b=None):', '        self.attr_0 = a', '        self.attr_1 = b', '']
+        for k in range(max(1, methods)):
+            src += _gen_function(rnd, f'method_{k}', names, 4, 2, is_method=True)
+
+    k = 1
+    while len(src) < lines:
+        src += _gen_function(rnd, f'f{i}_{k}', names, 0, rnd.randint(2, 6))
+        k += 1
+
+    return '\n'.join(src).replace('pkg_name', pkg) + '\n'
+
+
+def generate_repo(root, pkg='synth', modules=50, classes=2, methods=3, fanout=4, lines=120, modules_per_pkg=10, seed=0):
+    '''
+    Write a synthetic repository to root/pkg/pkg-1.0/
+    Return: paths of the modules (relative to root)
+    '''
+    rnd = random.Random(seed)
+    pkg_dir = os.path.join(root, pkg, f'{pkg}-1.0', pkg)
+    os.makedirs(pkg_dir, exist_ok=True)
+    with open(os.path.join(pkg_dir, '__init__.py'), 'w') as f:
+        f.write(f'"""Synthetic package {pkg}."""\n')
+
+    fpaths = []
+    for i in range(modules):
+        sub, mod = _module_path(i, modules_per_pkg)
+        sub_dir = os.path.join(pkg_dir, sub)
+        if not os.path.isdir(sub_dir):
+            os.makedirs(sub_dir)
+            with open(os.path.join(sub_dir, '__init__.py'), 'w') as f:
+                f.write('')
+
+        fpath = os.path.join(sub_dir, f'{mod}.py')
+        with open(fpath, 'w') as f:
+            f.write(gen_module(rnd, i, modules, classes, methods, fanout, lines, modules_per_pkg, pkg))
+        fpaths.append(os.path.relpath(fpath, root))
+
+    return fpaths
+
+
+def generate_samples(root, pkg, fpaths, num, seed=0):
+    '''
+    Completion samples {"pkg", "fpath", "input"}: the prefix of a module, cut in the middle of a line
+    '''
+    rnd = random.Random(seed)
+    samples = []
+    for _ in range(num):
+        fpath = rnd.choice(fpaths)
+        with open(os.path.join(root, fpath), 'r') as f:
+            lines = f.read().split('\n')
+        k = rnd.randint(len(lines) // 2, len(lines) - 1)
+        prefix = '\n'.join(lines[:k]) + '\n' + lines[k][:len(lines[k]) // 2]
+        samples.append({"pkg": pkg, "fpath": fpath, "input": prefix})
+
+    return samples
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument('-o', '--out', required=True, help='directory of the repository')
+    parser.add_argument('--pkg', default='synth', help='package name')
+    parser.add_argument('--modules', type=int, default=50, help='number of modules')
+    parser.add_argument('--classes', type=int, default=2, help='classes per module')
+    parser.add_argument('--methods', type=int, default=3, help='methods per class')
+    parser.add_argument('--fanout', type=int, default=4, help='modules imported by each module')
+    parser.add_argument('--lines', type=int, default=120, help='minimum lines per module')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    fpaths = generate_repo(args.out, args.pkg, args.modules, args.classes, args.methods, args.fanout, args.lines, seed=args.seed)
+    print(f'Generate {len(fpaths)} modules in {os.path.join(args.out, args.pkg)}')
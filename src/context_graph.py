@@ -0,0 +1,246 @@
+import os
+import json
+import mmap
+import struct
+from collections.abc import Mapping
+
+
+'''
+Binary format of the repo-specific context graph (little-endian)
+
+header:  magic, version, string number, module number, string table offset, module index offset
+records: one record per module, encoded by the tags below (strings are ids in the string table)
+strings: (string number + 1) offsets, followed by the utf-8 bytes of all strings
+index:   (module name id, record offset, record length) for each module, in the order of the graph
+'''
+MAGIC = b'DRCG'
+VERSION = 1
+
+HEADER = struct.Struct('<4sIIIQQ')
+INDEX_ITEM = struct.Struct('<IQI')
+U32 = struct.Struct('<I')
+I64 = struct.Struct('<q')
+
+TAG_NONE = 0
+TAG_TRUE = 1
+TAG_FALSE = 2
+TAG_INT = 3
+TAG_STR = 4
+TAG_LIST = 5
+TAG_DICT = 6
+
+
+class _recordEncoder(object):
+    def __init__(self):
+        # interned strings: {string: id}
+        self.str_ids = {}
+
+
+    def _get_str_id(self, s):
+        sid = self.str_ids.get(s, None)
+        if sid is None:
+            sid = len(self.str_ids)
+            self.str_ids[s] = sid
+        return sid
+
+
+    def encode(self, value, buf):
+        if value is None:
+            buf.append(TAG_NONE)
+        elif value is True:
+            buf.append(TAG_TRUE)
+        elif value is False:
+            buf.append(TAG_FALSE)
+        elif isinstance(value, int):
+            buf.append(TAG_INT)
+            buf += I64.pack(value)
+        elif isinstance(value, str):
+            buf.append(TAG_STR)
+            buf += U32.pack(self._get_str_id(value))
+        elif isinstance(value, (list, tuple)):
+            buf.append(TAG_LIST)
+            buf += U32.pack(len(value))
+            for item in value:
+                self.encode(item, buf)
+        elif isinstance(value, dict):
+            buf.append(TAG_DICT)
+            buf += U32.pack(len(value))
+            for k, v in value.items():
+                buf += U32.pack(self._get_str_id(k))
+                self.encode(v, buf)
+        else:
+            raise TypeError(f'Unsupported value in context graph: {type(value)}')
+
+
+def dump_context_graph(proj_info, fpath):
+    '''
+    Save the result of projectParser.parse_dir in the binary format
+    The file is replaced atomically, so that the loaded graphs keep reading the old file
+    '''
+    encoder = _recordEncoder()
+    records = bytearray()
+    index = []
+    for module, file_info in proj_info.items():
+        offset = HEADER.size + len(records)
+        encoder.encode(file_info, records)
+        index.append((encoder._get_str_id(module), offset, HEADER.size + len(records) - offset))
+
+    strings = [s.encode('utf-8') for s in encoder.str_ids]
+    str_offsets = bytearray()
+    pos = 0
+    for s in strings:
+        str_offsets += struct.pack('<Q', pos)
+        pos += len(s)
+    str_offsets += struct.pack('<Q', pos)
+
+    strtab_offset = HEADER.size + len(records)
+    index_offset = strtab_offset + len(str_offsets) + pos
+
+    tmp_path = fpath + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(strings), len(index), strtab_offset, index_offset))
+        f.write(records)
+        f.write(str_offsets)
+        for s in strings:
+            f.write(s)
+        for item in index:
+            f.write(INDEX_ITEM.pack(*item))
+    os.replace(tmp_path, fpath)
+
+
+class LazyContextGraph(Mapping):
+    '''
+    Read-only {module: {name: info}} backed by a memory-mapped binary graph
+    A module is decoded only when it is accessed for the first time
+    '''
+    def __init__(self, fpath):
+        self.fpath = fpath
+        with open(fpath, 'rb') as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.str_num, module_num, self.strtab_offset, index_offset = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'Unknown context graph format: {fpath}')
+
+        self.str_cache = {}
+        self.blob_offset = self.strtab_offset + 8 * (self.str_num + 1)
+
+        # {module: (offset, length)}
+        self.index = {}
+        for i in range(module_num):
+            sid, offset, length = INDEX_ITEM.unpack_from(self.buf, index_offset + i * INDEX_ITEM.size)
+            self.index[self._get_str(sid)] = (offset, length)
+
+        # decoded modules, and the total length of their records
+        self.modules = {}
+        self.decoded_bytes = 0
+
+
+    def _get_str(self, sid):
+        s = self.str_cache.get(sid, None)
+        if s is None:
+            start, end = struct.unpack_from('<QQ', self.buf, self.strtab_offset + 8 * sid)
+            s = self.buf[self.blob_offset+start:self.blob_offset+end].decode('utf-8')
+            self.str_cache[sid] = s
+        return s
+
+
+    def _decode(self, pos):
+        tag = self.buf[pos]
+        pos += 1
+        if tag == TAG_NONE:
+            return None, pos
+        elif tag == TAG_TRUE:
+            return True, pos
+        elif tag == TAG_FALSE:
+            return False, pos
+        elif tag == TAG_INT:
+            return I64.unpack_from(self.buf, pos)[0], pos + 8
+        elif tag == TAG_STR:
+            return self._get_str(U32.unpack_from(self.buf, pos)[0]), pos + 4
+        elif tag == TAG_LIST:
+            num = U32.unpack_from(self.buf, pos)[0]
+            pos += 4
+            ret = []
+            for _ in range(num):
+                value, pos = self._decode(pos)
+                ret.append(value)
+            return ret, pos
+        elif tag == TAG_DICT:
+            num = U32.unpack_from(self.buf, pos)[0]
+            pos += 4
+            ret = {}
+            for _ in range(num):
+                key = self._get_str(U32.unpack_from(self.buf, pos)[0])
+                value, pos = self._decode(pos + 4)
+                ret[key] = value
+            return ret, pos
+        else:
+            raise ValueError(f'Broken context graph: {self.fpath}')
+
+
+    def __getitem__(self, module):
+        file_info = self.modules.get(module, None)
+        if file_info is None:
+            offset, length = self.index[module]
+            file_info = self._decode(offset)[0]
+            self.modules[module] = file_info
+            self.decoded_bytes += length
+        return file_info
+
+
+    def __contains__(self, module):
+        return module in self.index
+
+
+    def __iter__(self):
+        return iter(self.index)
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+    def close(self):
+        self.buf.close()
+
+
+
+class ExcludedGraphView(Mapping):
+    '''
+    Read-only view of a graph (dict or LazyContextGraph) that hides one module without copying
+    '''
+    def __init__(self, graph, module):
+        self.graph = graph
+        self.excluded = module
+
+
+    def __getitem__(self, module):
+        if module == self.excluded:
+            raise KeyError(module)
+        return self.graph[module]
+
+
+    def __contains__(self, module):
+        return module != self.excluded and module in self.graph
+
+
+    def __iter__(self):
+        for module in self.graph:
+            if module != self.excluded:
+                yield module
+
+
+    def __len__(self):
+        return len(self.graph) - (1 if self.excluded in self.graph else 0)
+
+
+def load_context_graph(fpath):
+    '''
+    Load a context graph saved by json.dump (.json) or dump_context_graph (.bin)
+    '''
+    if fpath.endswith('.bin'):
+        return LazyContextGraph(fpath)
+
+    with open(fpath, 'r') as f:
+        return json.load(f)
@@ -1,4 +1,5 @@
 import os
+import bisect
 import tree_sitter_python as tspython
 from tree_sitter import Language, Parser
 
@@ -28,6 +29,7 @@ class Leaf():
         self.ast_node = node
         self.var_name = var_name
         self.node_type = node_type
+        self.lineno = node.start_point[0]
 
         self.module = None
         self.name = None 
@@ -37,6 +39,9 @@ class DataflowGraph():
         self.leaf_cnt = 0
         self.dfg_nodes = {}
         self.dfg_edges = {EdgeType.__dict__[attr]:[] for attr in dir(EdgeType) if not attr.startswith('_')}
+        # {lineno: [node index]}, and the sorted line numbers
+        self.line_index = {}
+        self.linenos = []
 
     """
     # Install networkx and pydot for visualization
@@ -84,7 +89,60 @@ class DataflowGraph():
         if node_type == NodeType.IMPORT:
             dfg_node.module = module
             dfg_node.name = name
+
+        if dfg_node.lineno in self.line_index:
+            self.line_index[dfg_node.lineno].append(node_idx)
+        else:
+            self.line_index[dfg_node.lineno] = [node_idx]
+            bisect.insort(self.linenos, dfg_node.lineno)
         return dfg_node
+    
+
+    def truncate(self, leaf_cnt, edge_nums):
+        '''
+        Remove the nodes from leaf_cnt, and the edges after {edge type: edge number}
+        '''
+        # the last index of each line is removed first
+        for i in range(self.leaf_cnt - 1, leaf_cnt - 1, -1):
+            lineno = self.dfg_nodes.pop(i).lineno
+            indices = self.line_index[lineno]
+            indices.pop()
+            if not indices:
+                del self.line_index[lineno]
+                del self.linenos[bisect.bisect_left(self.linenos, lineno)]
+        self.leaf_cnt = leaf_cnt
+
+        for edge_type, edge_num in edge_nums.items():
+            del self.dfg_edges[edge_type][edge_num:]
+
+
+class ParseCache():
+    '''
+    Tree and DFG of the last source parsed for a file, reused by PythonParser.parse
+    '''
+    def __init__(self):
+        self.src = b''
+        self.tree = None
+        self.DFG = None
+        self.states = None
+        # [(start_byte, end_byte, type, leaf_cnt, {edge type: edge number}, global_states)] after each top-level statement
+        self.checkpoints = []
+
+
+def _common_prefix_length(a, b):
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _get_point(src, byte):
+    row = src.count(b'\n', 0, byte)
+    return (row, byte - src.rfind(b'\n', 0, byte) - 1)
 
 
 class PythonParser():
@@ -117,7 +175,14 @@ class PythonParser():
         self.global_states = {}
         self.global_var_name_ast_id = set()
 
-    def parse(self, src_code):
+    def parse(self, src_code, cache=None):
+        '''
+        cache: ParseCache of the file, the DFG of unchanged top-level statements is reused
+        '''
+        if cache is not None:
+            self._parse_incremental(bytes(src_code, "utf8"), cache)
+            return
+
         self.clear()
 
         self.root_node = self.parser.parse(bytes(src_code, "utf8")).root_node
@@ -126,6 +191,83 @@ class PythonParser():
         states = {}
         self.walk_ast(self.root_node, states)
 
+    def _parse_incremental(self, src, cache):
+        '''
+        Reparse the changed part of the tree, and walk the top-level statements after the last unchanged one
+        Between top-level statements, the class related states are always empty (or no longer used),
+        and the lists in states only grow, so the states are restored by the number of DFG nodes
+        '''
+        self.clear()
+
+        reuse_bytes = 0
+        if cache.tree is None:
+            tree = self.parser.parse(src)
+        else:
+            # edit a copy, the old nodes are still referred by the DFG
+            old_tree = cache.tree.copy()
+            prefix = _common_prefix_length(cache.src, src)
+            old_tree.edit(start_byte=prefix, old_end_byte=len(cache.src), new_end_byte=len(src),
+                          start_point=_get_point(src, prefix),
+                          old_end_point=_get_point(cache.src, len(cache.src)),
+                          new_end_point=_get_point(src, len(src)))
+            tree = self.parser.parse(src, old_tree)
+            
+            reuse_bytes = prefix
+            for changed_range in old_tree.changed_ranges(tree):
+                reuse_bytes = min(reuse_bytes, changed_range.start_byte)
+
+        self.root_node = tree.root_node
+        if self._is_variable(self.root_node):
+            statements = []
+        else:
+            statements = self.root_node.children
+
+        # unchanged statements
+        reuse_num = 0
+        for statement, checkpoint in zip(statements, cache.checkpoints):
+            if statement.end_byte > reuse_bytes or checkpoint[:3] != (statement.start_byte, statement.end_byte, statement.type):
+                break
+            reuse_num += 1
+
+        # the cache is invalid until the walk finishes
+        old_checkpoints = cache.checkpoints
+        cache.tree = None
+        cache.checkpoints = []
+
+        if reuse_num == 0:
+            self.DFG = DataflowGraph()
+            states = {}
+            checkpoints = []
+        else:
+            leaf_cnt, edge_nums, global_states = old_checkpoints[reuse_num-1][3:]
+            self.DFG = cache.DFG
+            self.DFG.truncate(leaf_cnt, edge_nums)
+
+            states = cache.states
+            for var in list(states.keys()):
+                indices = states[var]
+                while indices and indices[-1] >= leaf_cnt:
+                    indices.pop()
+                if not indices:
+                    del states[var]
+
+            self.global_states = dict(global_states)
+            checkpoints = old_checkpoints[:reuse_num]
+
+        if self._is_variable(self.root_node):
+            self.walk_ast(self.root_node, states)
+
+        for statement in statements[reuse_num:]:
+            self.walk_ast(statement, states)
+            edge_nums = {k: len(v) for k, v in self.DFG.dfg_edges.items()}
+            checkpoints.append((statement.start_byte, statement.end_byte, statement.type, self.DFG.leaf_cnt, edge_nums, dict(self.global_states)))
+        
+        cache.src = src
+        cache.tree = tree
+        cache.DFG = self.DFG
+        cache.states = states
+        cache.checkpoints = checkpoints
+
     def walk_ast(self, node, states):
         node_type = node.type
         
@@ -1,63 +1,170 @@
 import os
-import json
+import time
+from itertools import groupby
+from collections import OrderedDict
 
 try:
     from .graph import tGraph
-    from .extract_dataflow import PythonParser
-    from .node_prompt import projectSearcher
+    from .extract_dataflow import PythonParser, ParseCache
+    from .node_prompt import projectSearcher, promptBuilder
     from .tokenizer import ModelTokenizer
-    from .utils import MAX_HOP, ONLY_DEF, ENABLE_DOCSTRING, LAST_K_LINES
+    from .context_graph import ExcludedGraphView, LazyContextGraph, load_context_graph
+    from .profiler import stageProfiler
+    from .utils import MAX_HOP, ONLY_DEF, ENABLE_DOCSTRING, LAST_K_LINES, BUDGET_SEARCH, ADDITIVE_BUDGET, DFG_CACHE_SIZE, GRAPH_CACHE_BYTES, GRAPH_MEMORY_FACTOR, LAZY_GRAPH_MEMORY_FACTOR, PROFILE
 except:
     from graph import tGraph
-    from extract_dataflow import PythonParser
-    from node_prompt import projectSearcher
+    from extract_dataflow import PythonParser, ParseCache
+    from node_prompt import projectSearcher, promptBuilder
     from tokenizer import ModelTokenizer
-    from utils import MAX_HOP, ONLY_DEF, ENABLE_DOCSTRING, LAST_K_LINES
+    from context_graph import ExcludedGraphView, LazyContextGraph, load_context_graph
+    from profiler import stageProfiler
+    from utils import MAX_HOP, ONLY_DEF, ENABLE_DOCSTRING, LAST_K_LINES, BUDGET_SEARCH, ADDITIVE_BUDGET, DFG_CACHE_SIZE, GRAPH_CACHE_BYTES, GRAPH_MEMORY_FACTOR, LAZY_GRAPH_MEMORY_FACTOR, PROFILE
 
 
 class Generator(object):
-    def __init__(self, proj_dir, info_dir, model):
+    def __init__(self, proj_dir, info_dir, model, graph_cache_bytes=GRAPH_CACHE_BYTES, prewarm=None, tokenizer=None):
+        '''
+        graph_cache_bytes: memory budget (estimated bytes) of the loaded project graphs
+        prewarm: projects whose graphs are loaded at startup
+        tokenizer: a ModelTokenizer used instead of the tokenizer of model, e.g., a stand-in in benchmarks
+        '''
         self.parser = PythonParser()
         self.proj_dir = os.path.abspath(proj_dir)
         self.info_dir = os.path.abspath(info_dir)
 
         self.searcher = projectSearcher()
-        self.tokenizer = ModelTokenizer(model)
+        self.tokenizer = tokenizer if tokenizer is not None else ModelTokenizer(model)
 
         self.project = None
         self.proj_info = None
+        # {(module, name): resolved import} of current file, saved in the graph by preprocess.py
+        self.resolved_imports = {}
+        # {project: root directory}
+        self.proj_roots = {}
+        # cost of each group in retrieve_prompts
+        self.group_stats = []
+        # latency of the stages in retrieval
+        self.profiler = stageProfiler(PROFILE)
+        # {(project, module): ParseCache}, least recently used first
+        self.parse_caches = OrderedDict()
+
+        # LRU cache of project graphs: {project: (graph, estimated bytes)}
+        self.graphs = OrderedDict()
+        self.graph_cache_bytes = graph_cache_bytes
+        self.graph_bytes = 0
+        self.graph_hits = 0
+        self.graph_misses = 0
+        self.graph_evictions = 0
+        for project in prewarm or []:
+            if self._get_graph(project) is None:
+                print(f'Unknown package {project} in {self.info_dir}')
     
 
     def _set_project(self, project):
-        if project == self.project:
-            return
-
-        info_file = os.path.join(self.info_dir, f'{project}.json')
-        if not os.path.isfile(info_file):
+        graph = self._get_graph(project)
+        if graph is None:
             print(f'Unknown package {project} in {self.info_dir}')
             return
         
         self.project = project
-        with open(info_file, 'r') as f:
-            self.proj_info = json.load(f)
+        self.proj_info = graph
+
+
+    def _get_graph(self, project):
+        '''
+        Graph of project from the LRU cache, or load it
+        '''
+        if project in self.graphs:
+            self.graph_hits += 1
+            self.graphs.move_to_end(project)
+            self._evict_graphs()
+            return self.graphs[project][0]
+
+        self.graph_misses += 1
+        # prefer the binary graph, which is decoded lazily
+        info_file = os.path.join(self.info_dir, f'{project}.bin')
+        if not os.path.isfile(info_file):
+            info_file = os.path.join(self.info_dir, f'{project}.json')
+        if not os.path.isfile(info_file):
+            return None
+        
+        graph = load_context_graph(info_file)
+        graph_bytes = GRAPH_MEMORY_FACTOR * os.path.getsize(info_file)
+        self.graphs[project] = (graph, graph_bytes)
+        self._evict_graphs()
+        
+        return graph
+
+
+    def _evict_graphs(self):
+        '''
+        Evict the least recently used graphs over budget, the latest graph is always kept
+        '''
+        self._update_graph_bytes()
+        while self.graph_bytes > self.graph_cache_bytes and len(self.graphs) > 1:
+            _, (evicted, evicted_bytes) = self.graphs.popitem(last=False)
+            self.graph_bytes -= evicted_bytes
+            self.graph_evictions += 1
+            if isinstance(evicted, LazyContextGraph):
+                evicted.close()
+
+
+    def _update_graph_bytes(self):
+        '''
+        The estimated bytes of a lazily decoded graph grow with its decoded modules
+        '''
+        self.graph_bytes = 0
+        for project, (graph, graph_bytes) in self.graphs.items():
+            if isinstance(graph, LazyContextGraph):
+                graph_bytes = LAZY_GRAPH_MEMORY_FACTOR * graph.decoded_bytes
+                self.graphs[project] = (graph, graph_bytes)
+            self.graph_bytes += graph_bytes
+
+
+    def graph_cache_info(self):
+        self._update_graph_bytes()
+        return {
+            "hits": self.graph_hits,
+            "misses": self.graph_misses,
+            "evictions": self.graph_evictions,
+            "size": len(self.graphs),
+            "bytes": self.graph_bytes,
+            "maxbytes": self.graph_cache_bytes
+        }
     
 
+    def _get_project_root(self, project):
+        '''
+        package/ or package/package-version/ (cached)
+        '''
+        dir_path = self.proj_roots.get(project, None)
+        if dir_path is None:
+            dir_path = os.path.join(self.proj_dir, project)
+            if os.path.isdir(dir_path):
+                content = list(os.listdir(dir_path))
+                if len(content) == 1:
+                    dir_path = os.path.join(dir_path, content[0])
+            self.proj_roots[project] = dir_path
+        
+        return dir_path
+
+
     def set_pyfile(self, project, fpath):
+        with self.profiler.span('set_pyfile'):
+            self._set_pyfile(project, fpath)
+
+
+    def _set_pyfile(self, project, fpath):
         self._set_project(project)
         
         # remove current file
         if fpath in self.proj_info:
-            proj_info = {k:v for k,v in self.proj_info.items() if k != fpath}
+            proj_info = ExcludedGraphView(self.proj_info, fpath)
         else:
             proj_info = self.proj_info
         
-        dir_path = os.path.join(self.proj_dir, project)
-        if os.path.isdir(dir_path):
-            content = list(os.listdir(dir_path))
-            if len(content) == 1:
-                dir_path = os.path.join(dir_path, content[0])
-        
-        self.searcher.set_proj(dir_path, proj_info)
+        self.searcher.set_proj(self._get_project_root(project), proj_info)
+        self._set_resolved_imports(self._get_module_name(fpath))
     
 
     def _get_module_name(self, fpath):
@@ -70,6 +177,30 @@ class Generator(object):
         return fpath[len(self.searcher.proj_dir):].replace(os.sep, '.')
 
 
+    def _set_resolved_imports(self, fpath):
+        self.resolved_imports = {}
+        file_info = self.proj_info.get(fpath, None) if self.proj_info is not None else None
+        if file_info is not None and '' in file_info:
+            for module, name, find_info in file_info[''].get('resolved_imports', []):
+                self.resolved_imports[(module, name)] = find_info
+
+
+    def is_local_import(self, fpath, imported_info):
+        '''
+        Look up the imports resolved in preprocessing, and resolve the others in the project
+        '''
+        key = tuple(imported_info)
+        if key in self.resolved_imports:
+            find_info = self.resolved_imports[key]
+            if find_info is None:
+                return None
+            elif find_info[0] != fpath:
+                # an import resolved to current file may be hidden
+                return list(find_info)
+        
+        return self.searcher.is_local_import(fpath, imported_info)
+
+
     def get_suffix(self, fpath):
         return self.searcher.get_path_comment(fpath)
     
@@ -83,54 +214,212 @@ class Generator(object):
         return [x[:-1] for x in sorted_list]
 
 
+    def get_cross_file_node(self, fpath, imported_info):
+        '''
+        Return: (fpath, name) of a local import, or None
+        '''
+        find_info = self.is_local_import(fpath, imported_info)
+        if find_info is None:
+            return None
+        elif find_info[1] is None:
+            return (find_info[0], '')
+        else:
+            return tuple(find_info)
+
+
     def get_cross_file_nodes(self, fpath, imported_info):
         node_list = []
         for item in imported_info:
-            find_info = self.searcher.is_local_import(fpath, item)
-            if find_info is not None:
-                if find_info[1] is None:
-                    find_info = (find_info[0], '')
-                else:
-                    find_info = tuple(find_info)
-                
-                if find_info not in node_list:
-                    node_list.append(find_info)
+            find_info = self.get_cross_file_node(fpath, item)
+            if find_info is not None and find_info not in node_list:
+                node_list.append(find_info)
         
         return node_list
     
 
-    def get_prompt(self, node_list):
-        return self.searcher.get_prompt(node_list, MAX_HOP, ONLY_DEF, ENABLE_DOCSTRING)
+    def judge_prompt(self, prompt_snippets, max_length, tokens=None):
+        '''
+        prompt_snippets: (prompt, snippets) from promptBuilder.build
+        tokens: running sum of the token numbers of snippets kept by promptBuilder
+        '''
+        with self.profiler.span('budget'):
+            if ADDITIVE_BUDGET or tokens is not None:
+                return self.tokenizer.judge_snippets(prompt_snippets[1], max_length, tokens)
+            else:
+                return self.tokenizer.judge_prompt(prompt_snippets[0], max_length)
+
+
+    def _build_prompt(self, builder, node_list):
+        with self.profiler.span('get_prompt'):
+            return builder.build(node_list)
+
+
+    def _get_prefix_nodes(self, fpath, imported_dict, other_imported_dict, prefix):
+        '''
+        Cross-file nodes of imported_dict (Part 1) together with the imports in prefix (Part 2)
+        '''
+        imported_dict = dict(imported_dict)
+        for item in prefix:
+            if item not in imported_dict:
+                imported_dict[item] = other_imported_dict[item]
+            else:
+                imported_dict[item] = min(imported_dict[item], other_imported_dict[item])
+
+        imported_info = self.sort_by_lineno([(k[0], k[1], v) for k, v in imported_dict.items()])
+        return self.get_cross_file_nodes(fpath, imported_info)
+
+
+    def _fit_prompt_bisect(self, fpath, builder, imported_dict, other_imported_dict, sorted_others, max_prompt_length):
+        '''
+        Galloping search for the longest prefix of sorted_others that fits max_prompt_length:
+        the prefixes 1, 2, 4, ... imports longer than the acceptable one are probed, then the last gap is bisected
+        Same as the linear growth in _retrieve_prompt if the number of tokens grows with the prefix
+        Only the probed prefixes are built
+        '''
+        # prefixes are taken without judging while the prompt is empty
+        lo, hi = 0, len(sorted_others)
+        # bisect is set once the upper bound is found
+        bisect = False
+        step = 1
+        while lo < hi:
+            mid = (lo + hi) // 2 if bisect else min(lo + step - 1, hi - 1)
+            if len(self._build_prompt(builder, self._get_prefix_nodes(fpath, imported_dict, other_imported_dict, sorted_others[:mid]))[0]) > 0:
+                hi = mid
+                bisect = True
+            else:
+                lo = mid + 1
+                step *= 2
+        
+        # lo: the longest prefix known to be acceptable
+        hi = len(sorted_others)
+        bisect = False
+        step = 1
+        # {prompt: whether it fits}, the same prompt is not judged again
+        judged = {}
+        while lo < hi:
+            mid = (lo + hi + 1) // 2 if bisect else min(lo + step, hi)
+            prompt_snippets = self._build_prompt(builder, self._get_prefix_nodes(fpath, imported_dict, other_imported_dict, sorted_others[:mid]))
+            if prompt_snippets[0] not in judged:
+                judged[prompt_snippets[0]] = self.judge_prompt(prompt_snippets, max_prompt_length, builder.tokens)
+            
+            if judged[prompt_snippets[0]]:
+                lo = mid
+                step *= 2
+            else:
+                hi = mid - 1
+                bisect = True
+        
+        return self._build_prompt(builder, self._get_prefix_nodes(fpath, imported_dict, other_imported_dict, sorted_others[:lo]))[0]
+
+
+    def retrieve_prompts(self, items):
+        '''
+        items: [(project, fpath, source_code)]
+        The items are grouped by (project, fpath), so that each group shares the project and file setup
+        Return: [(prompt, failure)] in the original order, failure is None or {"pkg", "fpath", "error"} if the item fails;
+        the cost of each group is saved in self.group_stats, and recorded as the "group" stage of the profiler
+        '''
+        order = sorted(range(len(items)), key=lambda i:(items[i][0], items[i][1]))
+
+        ret = [None] * len(items)
+        self.group_stats = []
+        for (project, fpath), group in groupby(order, key=lambda i:(items[i][0], items[i][1])):
+            group = list(group)
+            start_time = time.time()
+
+            with self.profiler.span('group'):
+                failure = None
+                try:
+                    self.set_pyfile(project, fpath)
+                    module = self._get_module_name(fpath)
+                except Exception as e:
+                    failure = {"pkg": project, "fpath": fpath, "error": repr(e)}
+                setup_time = time.time() - start_time
+
+                for i in group:
+                    if failure is not None:
+                        ret[i] = (None, failure)
+                        continue
+
+                    try:
+                        with self.profiler.request():
+                            prompt = self._retrieve_prompt(module, items[i][2])
+                    except Exception as e:
+                        ret[i] = (None, {"pkg": project, "fpath": fpath, "error": repr(e)})
+                    else:
+                        ret[i] = (prompt, None)
+            
+            self.group_stats.append({
+                "project": project,
+                "fpath": fpath,
+                "size": len(group),
+                "setup_time": setup_time,
+                "time": time.time() - start_time
+            })
+        
+        return ret
 
 
     def retrieve_prompt(self, project, fpath, source_code):
+        with self.profiler.request():
+            self.set_pyfile(project, fpath)
+            return self._retrieve_prompt(self._get_module_name(fpath), source_code)
+
+
+    def parse_source(self, fpath, source_code):
         '''
-        last k lines + other import nodes until maximum length, only type-sensitive rels for k lines
+        Parse the source code with the tree and DFG of the last completion in the same file
         '''
-        self.set_pyfile(project, fpath)
+        if DFG_CACHE_SIZE <= 0:
+            self.parser.parse(source_code)
+            return
+
+        key = (self.project, fpath)
+        cache = self.parse_caches.pop(key, None)
+        if cache is None:
+            cache = ParseCache()
+        self.parse_caches[key] = cache
+        while len(self.parse_caches) > DFG_CACHE_SIZE:
+            self.parse_caches.popitem(last=False)
+        
+        self.parser.parse(source_code, cache)
 
-        fpath = self._get_module_name(fpath)
 
-        self.parser.parse(source_code)
+    def _retrieve_prompt(self, fpath, source_code):
+        '''
+        last k lines + other import nodes until maximum length, only type-sensitive rels for k lines
+        fpath: module name of current file, which is set by set_pyfile
+        '''
+        profiler = self.profiler
+        with profiler.span('parse'):
+            self.parse_source(fpath, source_code)
 
         limit_assign = True
-        graph = tGraph(self.parser.DFG)
+        with profiler.span('tgraph'):
+            graph = tGraph(self.parser.DFG)
 
         # check cross-file imports
         cross_import_nodes = set()
-        for k, v in graph.node_dict.items():
-            if v.node_type == 'import' and self.searcher.is_local_import(fpath, (v.module, v.name)) is not None:
-                cross_import_nodes.add(k)
+        with profiler.span('cross_imports'):
+            for k, v in graph.node_dict.items():
+                if v.node_type == 'import' and self.is_local_import(fpath, (v.module, v.name)) is not None:
+                    cross_import_nodes.add(k)
+        
+        if profiler.enabled:
+            profiler.count('nodes', len(graph.node_dict))
+            profiler.count('edges', len(graph.csr_in.indices))
+            profiler.count('cross_imports', len(cross_import_nodes))
+            token_calls = self.tokenizer.token_calls
 
-        # Part1: imported information from last k lines
-        variable_nodes = graph.get_last_k_lines(LAST_K_LINES)
-        related_nodes = graph.get_related_nodes(variable_nodes, reverse=True, limit_assign=limit_assign)
-        proj_nodes = set(related_nodes) & cross_import_nodes
+        # nodes related to the imports of last k lines (Part 1) and other imports (Part 2)
+        with profiler.span('related_nodes'):
+            variable_nodes = graph.get_last_k_lines(LAST_K_LINES)
+            proj_nodes, related_nodes, other_proj_nodes, other_related_nodes = graph.get_import_related_nodes(variable_nodes, cross_import_nodes, limit_assign=limit_assign)
         
-        # subgraph
-        related_nodes = graph.get_related_nodes(variable_nodes, reverse=True, end_nodes=proj_nodes, limit_assign=limit_assign)
+        # Part1: imported information from last k lines
         # create subgraph
-        subgraph = graph.get_assign_subgraph(related_nodes, proj_nodes)
+        with profiler.span('assign_subgraph'):
+            subgraph = graph.get_assign_subgraph(related_nodes, proj_nodes)
         # all nodes with module info in subgraph
         imported_dict = {}
         for k, v in subgraph.module_info.items():
@@ -145,10 +434,9 @@ class Generator(object):
                     imported_dict[info] = min(imported_dict[info], pos)
 
         # Part2: other import nodes
-        other_proj_nodes = cross_import_nodes - proj_nodes
-        related_nodes = graph.get_related_nodes(other_proj_nodes, reverse=False, end_nodes=None, limit_assign=True)
         # create subgraph
-        subgraph = graph.get_assign_subgraph(related_nodes, other_proj_nodes)
+        with profiler.span('assign_subgraph'):
+            subgraph = graph.get_assign_subgraph(other_related_nodes, other_proj_nodes)
         # all nodes with module info in subgraph
         other_imported_dict = {}
         for k, v in subgraph.module_info.items():
@@ -164,27 +452,63 @@ class Generator(object):
         
         # get maximum prompt length
         suffix = self.get_suffix(fpath)
-        max_prompt_length = self.tokenizer.cal_prompt_max_length(source_code, suffix)
+        with profiler.span('budget'):
+            max_prompt_length = self.tokenizer.cal_prompt_max_length(source_code, suffix)
+
+        # the closure and snippet of each import are built once,
+        # and the token numbers of snippets are summed up for the linear search and additive checks
+        tokenizer = self.tokenizer if BUDGET_SEARCH != 'bisect' or ADDITIVE_BUDGET else None
+        builder = promptBuilder(self.searcher, MAX_HOP, ONLY_DEF, ENABLE_DOCSTRING, tokenizer)
 
         # prompt from Part 1
         imported_info = self.sort_by_lineno([(k[0], k[1], v) for k, v in imported_dict.items()])
         node_list = self.get_cross_file_nodes(fpath, imported_info)
-        prompt = self.get_prompt(node_list)
+        prompt = self._build_prompt(builder, node_list)[0]
+        # None: prompt is not judged yet
+        prompt_fits = None
 
         # other imported info from Part 2
         sorted_others = sorted(other_imported_dict, key=lambda x:other_imported_dict[x])
-        for item in sorted_others:
-            if item not in imported_dict:
-                imported_dict[item] = other_imported_dict[item]
-            else:
-                imported_dict[item] = min(imported_dict[item], other_imported_dict[item])
+        if BUDGET_SEARCH == 'bisect':
+            prompt = self._fit_prompt_bisect(fpath, builder, imported_dict, other_imported_dict, sorted_others, max_prompt_length)
+        else:
+            # pos and cross-file node of each import in the order of imported_info
+            pos_list = sorted(imported_dict.values(), reverse=True)
+            item_nodes = [self.get_cross_file_node(fpath, x) for x in imported_info]
+            new_prompt, snippets = prompt, builder.snippets
+            for item in sorted_others:
+                # an import of Part 1 keeps its smaller pos, and the prompt is unchanged
+                if item not in imported_dict:
+                    pos = imported_dict[item] = other_imported_dict[item]
+                    # the same place as in sort_by_lineno: after the imports with larger or equal pos,
+                    # which are the previous ones with equal pos since sorted_others is in ascending pos
+                    i = 0
+                    while i < len(pos_list) and pos_list[i] >= pos:
+                        i += 1
+                    node = self.get_cross_file_node(fpath, item)
+                    if node is not None and node not in item_nodes[:i]:
+                        index = len(set(item_nodes[:i]) - {None})
+                        with profiler.span('get_prompt'):
+                            new_prompt, snippets = builder.insert(index, node)
+                    pos_list.insert(i, pos)
+                    item_nodes.insert(i, node)
 
-            imported_info = self.sort_by_lineno([(k[0], k[1], v) for k, v in imported_dict.items()])
-            node_list = self.get_cross_file_nodes(fpath, imported_info)
-            new_prompt = self.get_prompt(node_list)
-            if len(prompt) > 0 and not self.tokenizer.judge_prompt(new_prompt, max_prompt_length):
-                break
-            
-            prompt = new_prompt
+                if new_prompt == prompt and prompt_fits:
+                    # nothing new from this import
+                    continue
+
+                if len(prompt) > 0:
+                    if not self.judge_prompt((new_prompt, snippets), max_prompt_length, builder.tokens):
+                        break
+                    prompt_fits = True
+                else:
+                    prompt_fits = None
+                
+                prompt = new_prompt
+        
+        with profiler.span('truncate'):
+            prompt = self.tokenizer.truncate_concat(source_code, prompt, suffix)
         
-        return self.tokenizer.truncate_concat(source_code, prompt, suffix)
\ No newline at end of file
+        if profiler.enabled:
+            profiler.count('tokenizer_calls', self.tokenizer.token_calls - token_calls)
+        return prompt
\ No newline at end of file
@@ -1,97 +1,277 @@
 import heapq
+from operator import sub
+from itertools import accumulate, chain, repeat
 
 
 TRANS_RELS = {'assign', 'as', 'comesfrom', 'type', 'successor'}
 
+# {edge type: bit}, the bits of new edge types are added when they are seen
+EDGE_BITS = {}
+
+def get_edge_bit(edge_type):
+    bit = EDGE_BITS.get(edge_type, None)
+    if bit is None:
+        bit = 1 << len(EDGE_BITS)
+        EDGE_BITS[edge_type] = bit
+    return bit
+
+
+def get_edge_mask(edge_types):
+    mask = 0
+    for edge_type in edge_types:
+        mask |= get_edge_bit(edge_type)
+    return mask
+
+
+TRANS_MASK = get_edge_mask(sorted(TRANS_RELS))
+# all edge types
+ALL_MASK = -1
+
+# states of nodes in get_related_nodes
+UNSEEN = 0
+SEEN = 1
+RELATED = 2
+
+
+class csrTable(object):
+    def __init__(self, indptr, indices, types):
+        '''
+        Compressed sparse row table: the edges of position p go to indices[indptr[p]:indptr[p+1]] (positions of nodes)
+        '''
+        self.indptr = indptr
+        self.indices = indices
+        self.types = types
+        for edge_type in set(types):
+            get_edge_bit(edge_type)
+        self.masks = list(map(EDGE_BITS.__getitem__, types))
+
+
+    @classmethod
+    def from_edges(cls, node_num, rows, neighbors, types):
+        '''
+        CSR table of the edges rows[i] -> neighbors[i] of types[i], each row keeps the order of the given edges
+        '''
+        counts = [0] * (node_num + 1)
+        for p in rows:
+            counts[p+1] += 1
+        indptr = list(accumulate(counts))
+
+        order = sorted(range(len(rows)), key=rows.__getitem__)
+        return cls(indptr, list(map(neighbors.__getitem__, order)), list(map(types.__getitem__, order)))
+
+
+    def get_rows(self):
+        '''
+        Return: the row (position) of each edge
+        '''
+        return list(chain.from_iterable(map(repeat, range(len(self.indptr) - 1), map(sub, self.indptr[1:], self.indptr[:-1]))))
+
+
+    def transpose(self):
+        '''
+        CSR table of the reversed edges, in the order of rows and then edges in this table
+        '''
+        return csrTable.from_edges(len(self.indptr) - 1, self.indices, self.get_rows(), self.types)
+
+
 class tGraph(object):
     def __init__(self, df_graph=None):
+        self.module_info = {}
+        # {lineno: [node]} and the sorted line numbers, built from node_dict when it is not given by the DFG
+        self.line_index = None
+        self.linenos = None
         if df_graph:
             self._trans_tables(df_graph)
         else:
-            self.node_dict = {}
-            self.in_table = {}
-            self.out_table = {}
-        
-        self.module_info = {}
+            self._set_csr({}, [], None, csrTable([0], [], []))
     
 
-    def _clean_state(self):
-        self.visit_dict = {}
-        self.step_dict = {}
+    def _set_edges(self, node_dict, heads, tails, types):
+        '''
+        Integer positions of the nodes, and CSR tables of the edges tails[i] -> heads[i]
+        '''
+        csr_nodes = list(node_dict)
+        # the nodes of a DFG are numbered from 0, so that they are their own positions
+        if csr_nodes == list(range(len(csr_nodes))):
+            csr_index = None
+        else:
+            csr_index = {x: i for i, x in enumerate(csr_nodes)}
+            heads = list(map(csr_index.__getitem__, heads))
+            tails = list(map(csr_index.__getitem__, tails))
+        
+        csr_out = csrTable.from_edges(len(csr_nodes), tails, heads, types)
+        csr_in = csrTable.from_edges(len(csr_nodes), heads, tails, types)
+        self._set_csr(node_dict, csr_nodes, csr_index, csr_out, csr_in)
+
+
+    def _set_csr(self, node_dict, csr_nodes, csr_index, csr_out, csr_in=None):
+        '''
+        csr_in: the transpose of csr_out when it is None
+        '''
+        self.node_dict = node_dict
+        self.csr_nodes = csr_nodes
+        self.csr_index = csr_index
+        self.csr_out = csr_out
+        self._csr_in = csr_in
+        self._in_table = None
+        self._out_table = None
+
+
+    @property
+    def csr_in(self):
+        if self._csr_in is None:
+            self._csr_in = self.csr_out.transpose()
+        return self._csr_in
+
+
+    def _position(self, node):
+        if self.csr_index is None:
+            return node if node in self.node_dict else None
+        return self.csr_index.get(node, None)
 
     
     def _trans_tables(self, df_graph):
         '''
-        adjacency list
+        CSR tables of the DFG
         '''
-        self.node_dict = df_graph.dfg_nodes
-        self.in_table = {}
-        self.out_table = {}
+        heads = []
+        tails = []
+        types = []
+        for key, value in df_graph.dfg_edges.items():
+            if value:
+                head_nodes, tail_nodes = zip(*value)
+                heads += head_nodes
+                tails += tail_nodes
+                types += repeat(key, len(value))
+        
+        self._set_edges(df_graph.dfg_nodes, heads, tails, types)
+        self.line_index = df_graph.line_index
+        self.linenos = df_graph.linenos
 
-        for item in self.node_dict:
-            self.in_table[item] = []
-            self.out_table[item] = []
 
-        for key, value in df_graph.dfg_edges.items():
-            for item in value:
-                self.in_table[item[0]].append((item[1], key))
-                self.out_table[item[1]].append((item[0], key))
+    def _get_table(self, csr):
+        nodes = self.csr_nodes
+        table = {}
+        for p, x in enumerate(nodes):
+            start, end = csr.indptr[p], csr.indptr[p+1]
+            table[x] = list(zip(map(nodes.__getitem__, csr.indices[start:end]), csr.types[start:end]))
+        return table
+
+
+    @property
+    def in_table(self):
+        '''
+        adjacency list {node: [(tail, edge type)]}, built from the CSR table when it is used
+        '''
+        if self._in_table is None:
+            self._in_table = self._get_table(self.csr_in)
+        return self._in_table
+
+
+    @property
+    def out_table(self):
+        '''
+        adjacency list {node: [(head, edge type)]}
+        '''
+        if self._out_table is None:
+            self._out_table = self._get_table(self.csr_out)
+        return self._out_table
+
     
+    def _build_line_index(self):
+        self.line_index = {}
+        for k, v in self.node_dict.items():
+            if v.lineno in self.line_index:
+                self.line_index[v.lineno].append(k)
+            else:
+                self.line_index[v.lineno] = [k]
+        self.linenos = sorted(self.line_index)
+
+
     def get_last_k_lines(self, last_k=1):
         '''
         variables in (last_line + 1 - last_k ~ last_line)
         '''
+        if self.line_index is None:
+            self._build_line_index()
 
-        linenos = set([x.ast_node.start_point[0] for x in self.node_dict.values()])
-        last_lines = heapq.nlargest(last_k, linenos)
-
-        variables = [k for k,v in self.node_dict.items() if v.ast_node.start_point[0] in last_lines]
+        last_lines = self.linenos[-last_k:] if last_k > 0 else []
+        variables = [x for lineno in last_lines for x in self.line_index[lineno]]
+        # in the order of node_dict, then the position in code
+        variables.sort(key=self._position)
         variables.sort(key=lambda x:self.node_dict[x].ast_node.start_point)
 
         return variables
 
 
     def get_linenos(self, node_list):
-        return sorted(set([self.node_dict[x].ast_node.start_point[0] for x in node_list]), reverse=True)
+        return sorted(set([self.node_dict[x].lineno for x in node_list]), reverse=True)
     
 
-    def DFS_table(self, node, hop, limit_assign=False, reverse=False, end_nodes=None):
-        if node not in self.step_dict:
-            self.step_dict[node] = hop
-        else:
-            self.step_dict[node] = min(self.step_dict[node], hop)
+    def _related_positions(self, start_nodes, mask, reverse, end_nodes):
+        '''
+        Iterative DFS from each of start_nodes, which explores the edges and updates the nodes in the same order as a recursive DFS
+        A node is related if end_nodes is None, or it is an end node, or a related node is found after it in DFS
+        hop: minimum depth of the node in DFS (the explored edges to a visited node also count)
 
-        if node not in self.node_dict or node in self.visit_dict:
-            return
-        
-        if end_nodes is not None and node in end_nodes:
-            # is end node
-            self.visit_dict[node] = True
-            return
-        
-        if end_nodes is None:
-            self.visit_dict[node] = True
-        else:
-            self.visit_dict[node] = False
-
-        if reverse:
-            for x, edge_type in self.in_table[node]:
-                if not limit_assign or edge_type in TRANS_RELS:
-                    self.DFS_table(x, hop+1, limit_assign, reverse, end_nodes)
-                    if self.visit_dict[x]:
-                        self.visit_dict[node] = True
+        Return: [position] in the order of visiting, state and hop of each position
+        '''
+        csr = self.csr_in if reverse else self.csr_out
+        indptr, indices, masks = csr.indptr, csr.indices, csr.masks
+        nodes = self.csr_nodes
+        node_num = len(nodes)
+
+        state = [UNSEEN] * node_num
+        step = [node_num] * node_num
+        order = []
+        # (position, hop, parent position) of the edges to explore,
+        # hop is None to check the parent when the DFS from the position is finished
+        stack = []
+
+        for node in start_nodes:
+            p = self._position(node)
+            if p is None:
+                continue
+            
+            stack.append((p, 0, -1))
+            while stack:
+                x, hop, parent = stack.pop()
+                if hop is None:
+                    if state[x] == RELATED:
+                        state[parent] = RELATED
+                    continue
+                
+                if hop < step[x]:
+                    step[x] = hop
+                if state[x] != UNSEEN:
+                    if state[x] == RELATED and parent >= 0:
+                        state[parent] = RELATED
+                    continue
+                
+                order.append(x)
+                if end_nodes is None:
+                    state[x] = RELATED
+                elif nodes[x] in end_nodes:
+                    state[x] = RELATED
+                    if parent >= 0:
+                        state[parent] = RELATED
+                    continue
+                else:
+                    state[x] = SEEN
+                    if parent >= 0:
+                        stack.append((x, None, parent))
+                
+                hop += 1
+                for i in range(indptr[x+1] - 1, indptr[x] - 1, -1):
+                    if masks[i] & mask:
+                        stack.append((indices[i], hop, x))
         
-        else:
-            for x, edge_type in self.out_table[node]:
-                if not limit_assign or edge_type in TRANS_RELS:
-                    self.DFS_table(x, hop+1, limit_assign, reverse, end_nodes)
-                    if self.visit_dict[x]:
-                        self.visit_dict[node] = True
+        return order, state, step
 
     
     def get_related_nodes(self, start_nodes, limit_assign=False, reverse=False, end_nodes=None):
         '''
-        DFS via adjacency list
+        DFS via CSR tables
         start_nodes: cross-file nodes or variables in last line
         limit_assign: True / False
         reverse: True when start_nodes are variables, False when start_nodes are cross-file nodes
@@ -99,15 +279,57 @@ class tGraph(object):
 
         Return: {id: hop}
         '''
-        self._clean_state()
-        for node in start_nodes:
-            self.DFS_table(node, 0, limit_assign, reverse, end_nodes)
-        
-        return {k: self.step_dict[k] for k, v in self.visit_dict.items() if v}
+        mask = TRANS_MASK if limit_assign else ALL_MASK
+        order, state, step = self._related_positions(start_nodes, mask, reverse, end_nodes)
+        nodes = self.csr_nodes
+        return {nodes[p]: step[p] for p in order if state[p] == RELATED}
     
 
-    def trans_spec_rels(self, head, tail, rel_type):
-        # update module info
+    def get_import_related_nodes(self, start_nodes, import_nodes, limit_assign=False):
+        '''
+        The traversals of the imports in two passes, the same as
+            proj_nodes = set(get_related_nodes(start_nodes, limit_assign, reverse=True)) & import_nodes
+            get_related_nodes(start_nodes, limit_assign, reverse=True, end_nodes=proj_nodes)
+            get_related_nodes(import_nodes - proj_nodes, limit_assign, reverse=False)
+        1. DFS from start_nodes to the import nodes, all nodes visited by it are reachable, so it may end at any import node;
+           then the imports reached after them, the visited nodes are not walked again
+        2. DFS from the other import nodes
+        start_nodes: variables in last lines
+        import_nodes: set of cross-file nodes
+
+        Return: proj_nodes, {id: hop} in the paths to proj_nodes, other import nodes, {id: hop} from them
+        '''
+        mask = TRANS_MASK if limit_assign else ALL_MASK
+        order, state, step = self._related_positions(start_nodes, mask, True, import_nodes)
+        nodes = self.csr_nodes
+        proj_related_nodes = {nodes[p]: step[p] for p in order if state[p] == RELATED}
+
+        # reachable nodes in the order of visiting
+        reachable = list(order)
+        indptr, indices, masks = self.csr_in.indptr, self.csr_in.indices, self.csr_in.masks
+        stack = [p for p in reversed(order) if nodes[p] in import_nodes]
+        while stack:
+            p = stack.pop()
+            for i in range(indptr[p+1] - 1, indptr[p] - 1, -1):
+                x = indices[i]
+                if masks[i] & mask and state[x] == UNSEEN:
+                    state[x] = SEEN
+                    reachable.append(x)
+                    stack.append(x)
+        # a set from a dict like the result of get_related_nodes, which keeps the order of iteration
+        proj_nodes = set(dict.fromkeys(map(nodes.__getitem__, reachable))) & import_nodes
+
+        other_proj_nodes = import_nodes - proj_nodes
+        order, state, step = self._related_positions(other_proj_nodes, mask, False, None)
+        other_related_nodes = {nodes[p]: step[p] for p in order}
+
+        return proj_nodes, proj_related_nodes, other_proj_nodes, other_related_nodes
+    
+
+    def get_edge_name(self, head, tail, rel_type):
+        '''
+        The attribute name passed along a comesfrom edge, e.g., '.b' from a to a.b, '' for other edges
+        '''
         name = ''
         if rel_type == 'comesfrom':
             head_name = self.node_dict[head].var_name
@@ -116,6 +338,12 @@ class tGraph(object):
             begin_index = tail_name.find(head_name+'.')
             if begin_index >= 0:
                 name = tail_name[begin_index+len(head_name):]
+        return name
+
+
+    def trans_spec_rels(self, head, tail, rel_type):
+        # update module info
+        name = self.get_edge_name(head, tail, rel_type)
         
         if tail not in self.module_info:
             self.module_info[tail] = set()
@@ -128,33 +356,81 @@ class tGraph(object):
     
 
     def get_subgraph(self, related_nodes):
-        subgraph = tGraph()
+        csr = self.csr_out
+        nodes = self.csr_nodes
+        node_dict = {x: self.node_dict[x] for x in related_nodes}
+        csr_nodes = list(node_dict)
+        csr_index = {x: i for i, x in enumerate(csr_nodes)}
+
+        # edges between related nodes, in the order of the graph
+        indptr = [0]
+        indices = []
+        types = []
+        for x in csr_nodes:
+            p = self._position(x)
+            for i in range(csr.indptr[p], csr.indptr[p+1]):
+                y = nodes[csr.indices[i]]
+                if y in csr_index:
+                    indices.append(csr_index[y])
+                    types.append(csr.types[i])
+            indptr.append(len(indices))
 
-        for x in related_nodes:
-            subgraph.node_dict[x] = self.node_dict[x]
-            subgraph.in_table[x] = []
-            subgraph.out_table[x] = []
-        
-        for x in related_nodes:
-            for y in self.out_table[x]:
-                if y[0] in related_nodes:
-                    subgraph.in_table[y[0]].append((x, y[1]))
-                    subgraph.out_table[x].append(y)
-        
+        subgraph = tGraph()
+        subgraph._set_csr(node_dict, csr_nodes, csr_index, csrTable(indptr, indices, types))
         subgraph.module_info = {k:v for k,v in self.module_info.items() if k in related_nodes}
         
         return subgraph
 
-    def dfs4trans(self, node, visit_set):
-        if node in visit_set:
-            return
+    def dfs4trans(self, node):
+        '''
+        Iterative DFS from node via TRANS_RELS, module info is passed along each explored edge
+        '''
+        self.pass_module_info([node])
+
 
-        visit_set.add(node)
+    def pass_module_info(self, start_nodes):
+        '''
+        dfs4trans from each of start_nodes in turn
+        The module info is not passed again along an edge whose start has no new module info since the edge was explored last time,
+        which leads to the same module_info as passing all module info along it each time.
+        Each start node still explores all the edges it reaches, only the passing of module info is skipped.
+        '''
+        csr = self.csr_out
+        indptr, indices, masks, types = csr.indptr, csr.indices, csr.masks, csr.types
+        nodes = self.csr_nodes
+        module_info = self.module_info
+        # module info of each position, None if it is not set yet
+        infos = [module_info.get(x) for x in nodes]
+        # number of module info of the start when each edge was explored last time
+        passed = [0] * len(indices)
 
-        for item in self.out_table[node]:
-            if item[1] in TRANS_RELS:
-                self.trans_spec_rels(node, item[0], item[1])
-                self.dfs4trans(item[0], visit_set)
+        for node in start_nodes:
+            p = self._position(node)
+            visit_set = {p}
+            # (parent position, edge) to explore
+            stack = [(p, i) for i in range(indptr[p+1] - 1, indptr[p] - 1, -1) if masks[i] & TRANS_MASK]
+            while stack:
+                p, i = stack.pop()
+                x = indices[i]
+                if infos[x] is None:
+                    infos[x] = module_info[nodes[x]] = set()
+                
+                p_info = infos[p]
+                if passed[i] < len(p_info):
+                    passed[i] = len(p_info)
+                    name = self.get_edge_name(nodes[p], nodes[x], types[i]) if types[i] == 'comesfrom' else ''
+                    x_info = infos[x]
+                    for item in p_info:
+                        if item[1] is None:
+                            x_info.add((item[0], name.lstrip('.'), item[2]))
+                        elif name:
+                            x_info.add((item[0], item[1]+name, item[2]))
+                        else:
+                            x_info.add(item)
+                
+                if x not in visit_set:
+                    visit_set.add(x)
+                    stack += [(x, j) for j in range(indptr[x+1] - 1, indptr[x] - 1, -1) if masks[j] & TRANS_MASK]
     
 
     def get_assign_subgraph(self, related_nodes, import_nodes):
@@ -163,32 +439,33 @@ class tGraph(object):
         subgraph.module_info = {x: {(subgraph.node_dict[x].module, subgraph.node_dict[x].name, subgraph.node_dict[x].ast_node.start_point[0])} for x in import_nodes}
 
         # DFS via TRANS_RELS
-        for node in import_nodes:
-            subgraph.dfs4trans(node, set())
+        subgraph.pass_module_info(import_nodes)
         
         return subgraph
 
 
     def toposort_nodes(self):
-        in_table = {k: [x[0] for x in v] for k, v in self.in_table.items()}
-        out_table = {k: [x[0] for x in v] for k, v in self.out_table.items()}
-
-        sort_list = []
-        while len(out_table) > 0:
-            item = None
-            for k, v in out_table.items():
-                if len(v) == 0:
-                    item = k
-                    break
-            
-            assert item is not None
+        '''
+        Kahn's algorithm from the nodes without out edges, the first of them in node_dict is taken first
+        '''
+        out_indptr = self.csr_out.indptr
+        in_indptr, in_indices = self.csr_in.indptr, self.csr_in.indices
+        node_num = len(self.csr_nodes)
 
-            sort_list.append(item)
+        out_degree = [out_indptr[p+1] - out_indptr[p] for p in range(node_num)]
+        # sorted positions are a heap
+        heap = [p for p in range(node_num) if out_degree[p] == 0]
 
-            for x in out_table.pop(item):
-                in_table[x].remove(item)
-            
-            for x in in_table.pop(item):
-                out_table[x].remove(item)
+        sort_list = []
+        while heap:
+            p = heapq.heappop(heap)
+            sort_list.append(self.csr_nodes[p])
+            for i in range(in_indptr[p], in_indptr[p+1]):
+                x = in_indices[i]
+                out_degree[x] -= 1
+                if out_degree[x] == 0:
+                    heapq.heappush(heap, x)
+        
+        assert len(sort_list) == node_num
         
-        return sort_list
\ No newline at end of file
+        return sort_list
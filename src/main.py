@@ -1,37 +1,281 @@
 import os
 import json
+from collections import deque
+from multiprocessing import Pool
 from generator import Generator as promptGenerator
+from profiler import stageProfiler
 from utils import DS_REPO_DIR, DS_FILE, DS_GRAPH_DIR
 from argparse import ArgumentParser
 
 
-if __name__ == '__main__':
+# each worker process owns a generator
+_worker_generator = None
 
-    parser = ArgumentParser()
-    parser.add_argument('-m', '--model', required=True, help='Code LMs, incl. codegen, codegen25, santacoder, starcoder, codellama, gpt35, gpt4')
-    parser.add_argument('-f', '--file', required=True, help='prompt file')
-    args = parser.parse_args()
+def _init_worker(model, profile):
+    global _worker_generator
+    _worker_generator = promptGenerator(DS_REPO_DIR, DS_GRAPH_DIR, model)
+    _worker_generator.profiler.enabled = profile
 
-    generator = promptGenerator(DS_REPO_DIR, DS_GRAPH_DIR, args.model.lower())
 
-    with open(DS_FILE, 'r') as f:
-        dataset = [json.loads(line) for line in f.readlines()]
-    print(f'There are {len(dataset)} samples in ReccEval.')
-    
+def _generate_worker(samples):
+    '''
+    Return: results of generate_prompts, and the profiler of the samples
+    '''
+    ret = generate_prompts(_worker_generator, samples)
+    profiler = _worker_generator.profiler
+    _worker_generator.profiler = stageProfiler(profiler.enabled)
+    return ret, profiler
+
+
+def generate_prompts(generator, samples):
+    '''
+    samples: [(index, item)] of a package, the samples of the same file are generated successively
+    Return: [(index, prompt, failure)] in the order of index, failure is None or {"pkg", "fpath", "error"}
+    '''
+    items = [(item['pkg'], os.path.join(DS_REPO_DIR, item['fpath']), item['input']) for _, item in samples]
     ret = []
-    for i, item in enumerate(dataset):
-        fpath = os.path.join(DS_REPO_DIR, item['fpath'])
-        try:
-            prompt = generator.retrieve_prompt(item['pkg'], fpath, item['input'])
-        except Exception as e:
-            print(i, item['fpath'])
-            print(repr(e))
-            exit(0)
+    for (i, item), (prompt, failure) in zip(samples, generator.retrieve_prompts(items)):
+        if failure is not None:
+            # the relative path of the sample
+            failure = dict(failure, fpath=item['fpath'])
+        ret.append((i, prompt, failure))
+    return sorted(ret, key=lambda x:x[0])
+
+
+def read_samples(ds_file, start=0):
+    '''
+    Stream (index, item) of the samples from start
+    '''
+    with open(ds_file, 'r') as f:
+        for i, line in enumerate(f):
+            if i >= start:
+                yield i, json.loads(line)
+
+
+def read_pkgs(ds_file):
+    with open(ds_file, 'r') as f:
+        return [json.loads(line)['pkg'] for line in f]
+
+
+def split_by_pkg(pkgs, shard_num):
+    '''
+    Assign the packages to shard_num shards, larger packages first to the shard with fewest samples
+    pkgs: package of each sample
+    Return: {pkg: shard id}
+    '''
+    pkg_sizes = {}
+    for pkg in pkgs:
+        pkg_sizes[pkg] = pkg_sizes.get(pkg, 0) + 1
+
+    shard_of = {}
+    shard_sizes = [0] * shard_num
+    for pkg in sorted(pkg_sizes, key=lambda x:(-pkg_sizes[x], x)):
+        k = shard_sizes.index(min(shard_sizes))
+        shard_of[pkg] = k
+        shard_sizes[k] += pkg_sizes[pkg]
+
+    return shard_of
+
+
+def get_chunks(samples, chunk_size, selected_pkgs=None):
+    '''
+    Group the consecutive samples of the same package (in selected_pkgs) into chunks of at most chunk_size samples
+    '''
+    chunk = []
+    for i, item in samples:
+        if selected_pkgs is not None and item['pkg'] not in selected_pkgs:
+            continue
+        if chunk and (chunk[-1][1]['pkg'] != item['pkg'] or len(chunk) >= chunk_size):
+            yield chunk
+            chunk = []
+        chunk.append((i, item))
+
+    if chunk:
+        yield chunk
+
+
+def parse_shard(shard):
+    '''
+    i/n -> (i, n), 0 <= i < n
+    '''
+    try:
+        i, n = [int(x) for x in shard.split('/')]
+    except ValueError:
+        raise ValueError(f'Invalid shard {shard}, expected i/n')
+    if n <= 0 or not 0 <= i < n:
+        raise ValueError(f'Invalid shard {shard}, expected 0 <= i < n')
+    return i, n
+
+
+def count_written(out_file):
+    '''
+    Number of complete lines in out_file, an incomplete last line is truncated
+    '''
+    if not os.path.isfile(out_file):
+        return 0
+
+    num = 0
+    end = 0
+    with open(out_file, 'rb') as f:
+        pos = 0
+        while True:
+            block = f.read(1 << 20)
+            if not block:
+                break
+            num += block.count(b'\n')
+            last = block.rfind(b'\n')
+            if last >= 0:
+                end = pos + last + 1
+            pos += len(block)
+
+    if end != pos:
+        with open(out_file, 'r+b') as f:
+            f.truncate(end)
+    return num
+
+
+class promptWriter(object):
+    def __init__(self, out_file, start=0):
+        '''
+        One line per sample in out_file (null for failed and skipped samples), failures are saved in out_file.failed
+        start: number of samples already written, the new lines are appended
+        '''
+        self.fail_file = out_file + '.failed'
+        if start > 0:
+            # drop the failures of the samples that are not written
+            failures = []
+            if os.path.isfile(self.fail_file):
+                with open(self.fail_file, 'r') as f:
+                    failures = [line for line in f if line.strip() and json.loads(line)['index'] < start]
+            with open(self.fail_file, 'w') as f:
+                f.writelines(failures)
+
+        mode = 'a' if start > 0 else 'w'
+        self.f = open(out_file, mode)
+        self.fail_f = open(self.fail_file, mode)
+        self.next_index = start
+        self.prompt_num = 0
+        self.fail_num = 0
+
+
+    def _write_line(self, prompt):
+        json.dump(prompt, self.f)
+        self.f.write('\n')
+        self.next_index += 1
+
+
+    def skip_to(self, index):
+        while self.next_index < index:
+            self._write_line(None)
+
+
+    def write(self, index, prompt, failure=None):
+        self.skip_to(index)
+        if failure is not None:
+            self.fail_f.write(json.dumps(dict(index=index, **failure)) + '\n')
+            self.fail_f.flush()
+            self.fail_num += 1
         else:
-            ret.append(prompt)
+            self.prompt_num += 1
+
+        self._write_line(prompt)
+        self.f.flush()
+
 
-    print(f'Generate prompts for {len(ret)} samples.')
-    with open(args.file, 'w') as f:
+    def close(self, total):
+        self.skip_to(total)
+        self.f.close()
+        self.fail_f.close()
+
+
+def merge_shards(shard_files, out_file):
+    '''
+    Each shard file has a line for every sample, null for the samples of other shards
+    '''
+    ret = None
+    for shard_file in shard_files:
+        with open(shard_file, 'r') as f:
+            prompts = [json.loads(line) for line in f.readlines()]
+        if ret is None:
+            ret = prompts
+        elif len(ret) != len(prompts):
+            raise ValueError(f'{shard_file} has {len(prompts)} samples, expected {len(ret)}')
+        else:
+            ret = [x if x is not None else y for x, y in zip(ret, prompts)]
+
+    ret = ret or []
+    print(f'Merge {len(ret) - ret.count(None)} prompts of {len(ret)} samples.')
+    with open(out_file, 'w') as f:
         for item in ret:
             json.dump(item, f)
-            f.write('\n')
\ No newline at end of file
+            f.write('\n')
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument('-m', '--model', help='Code LMs, incl. codegen, codegen25, santacoder, starcoder, codellama, gpt35, gpt4')
+    parser.add_argument('-f', '--file', required=True, help='prompt file')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of processes, the samples are split by package')
+    parser.add_argument('-s', '--shard', default=None, help='i/n: only generate the prompts of shard i (of n), null for other samples')
+    parser.add_argument('-r', '--resume', action='store_true', help='skip the samples already written to the prompt file')
+    parser.add_argument('--chunk_size', type=int, default=64, help='maximum number of samples in a task of the processes')
+    parser.add_argument('-p', '--profile', default=None, help='save the latency of each stage (p50/p95/p99) and counters to a json file')
+    parser.add_argument('--merge', nargs='+', default=None, help='merge the prompt files of all shards into the prompt file')
+    args = parser.parse_args()
+
+    if args.merge:
+        merge_shards(args.merge, args.file)
+        exit(0)
+
+    if not args.model:
+        parser.error('the following arguments are required: -m/--model')
+
+    pkgs = read_pkgs(DS_FILE)
+    print(f'There are {len(pkgs)} samples in ReccEval.')
+
+    selected_pkgs = None
+    if args.shard:
+        shard_id, shard_num = parse_shard(args.shard)
+        shard_of = split_by_pkg(pkgs, shard_num)
+        selected_pkgs = set(k for k, v in shard_of.items() if v == shard_id)
+        print(f'Shard {shard_id}/{shard_num}: {sum(x in selected_pkgs for x in pkgs)} samples of {len(selected_pkgs)} packages.')
+
+    start = 0
+    if args.resume:
+        start = min(count_written(args.file), len(pkgs))
+        print(f'Resume from sample {start}.')
+
+    profiler = stageProfiler(args.profile is not None)
+    writer = promptWriter(args.file, start)
+    chunks = get_chunks(read_samples(DS_FILE, start), args.chunk_size, selected_pkgs)
+    if args.workers > 1:
+        with Pool(args.workers, initializer=_init_worker, initargs=(args.model.lower(), profiler.enabled)) as pool:
+            # a bounded window of chunks, whose results are written in order
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(_generate_worker, (chunk,)))
+                while len(pending) >= 4 * args.workers or (pending and pending[0].ready()):
+                    ret, chunk_profiler = pending.popleft().get()
+                    profiler.merge(chunk_profiler)
+                    for item in ret:
+                        writer.write(*item)
+            while pending:
+                ret, chunk_profiler = pending.popleft().get()
+                profiler.merge(chunk_profiler)
+                for item in ret:
+                    writer.write(*item)
+    else:
+        generator = promptGenerator(DS_REPO_DIR, DS_GRAPH_DIR, args.model.lower())
+        generator.profiler = profiler
+        for chunk in chunks:
+            for item in generate_prompts(generator, chunk):
+                writer.write(*item)
+    writer.close(len(pkgs))
+
+    if args.profile:
+        profiler.dump(args.profile)
+
+    print(f'Generate prompts for {writer.prompt_num} samples.')
+    if writer.fail_num:
+        print(f'Failed to generate prompts for {writer.fail_num} samples, see {writer.fail_file}.')
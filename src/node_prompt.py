@@ -1,49 +1,131 @@
 import os
 import json
+import heapq
 from itertools import groupby
+from collections import OrderedDict
 
 
 class projectSearcher(object):
-    def __init__(self) -> None:
+    def __init__(self, import_cache_size=4096) -> None:
         self.proj_dir = None
         self.proj_info = None
 
+        self.index_base = None
+        self.suffix_index = {}
+        self.candidates_cache = {}
+
+        # LRU cache of is_local_import: {(proj_dir, fpath, module, name): result}
+        self.import_cache = OrderedDict()
+        self.import_cache_size = import_cache_size
+        self.import_cache_hits = 0
+        self.import_cache_misses = 0
+        self.excluded = None
+
         with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'standard_modules.json'), 'r') as f:
             self.standard_modules = json.load(f)
     
 
     def set_proj(self, proj_dir, proj_info):
-        if proj_dir.endswith(os.sep):
-            self.proj_dir = proj_dir
-        else:
-            self.proj_dir = proj_dir + os.sep
-
+        if not proj_dir.endswith(os.sep):
+            proj_dir = proj_dir + os.sep
+
+        # views (e.g., ExcludedGraphView) share the index of their graph
+        base_info = getattr(proj_info, 'graph', proj_info)
+        excluded = getattr(proj_info, 'excluded', None)
+        if base_info is not self.index_base:
+            self._build_module_index(base_info)
+            self.clear_import_cache()
+        elif self.proj_dir != proj_dir or self.excluded != excluded:
+            self.clear_import_cache()
+
+        self.proj_dir = proj_dir
         self.proj_info = proj_info
+        self.excluded = excluded
+
+
+    def clear_import_cache(self):
+        self.import_cache.clear()
+
+
+    def import_cache_info(self):
+        return {
+            "hits": self.import_cache_hits,
+            "misses": self.import_cache_misses,
+            "size": len(self.import_cache),
+            "maxsize": self.import_cache_size
+        }
+
+
+    def _build_module_index(self, base_info):
+        '''
+        suffix_index: {dotted suffix: [module]}, e.g., 'b.c' -> ['a.b.c', 'b.c']
+        '''
+        self.index_base = base_info
+        self.suffix_index = {}
+        # {(module, fpath): candidate modules sorted by distance}
+        self.candidates_cache = {}
+
+        for module in base_info:
+            split_info = module.split('.')
+            for i in range(len(split_info)):
+                suffix = '.'.join(split_info[i:])
+                if suffix not in self.suffix_index:
+                    self.suffix_index[suffix] = [module]
+                else:
+                    self.suffix_index[suffix].append(module)
 
 
     def name_in_file(self, name, avail_list, src_name=None, cls=None):
         '''
         Find the available name in current file
+        avail_list: the names in current file, preferably the file info itself (any container with fast lookups)
+
+        The longest available dotted prefix of name is returned, so only the prefixes of name are looked up
         '''
 
         if name.startswith('self.') and cls:
             name = f'{cls}{name[4:]}'
 
-        for item in sorted(avail_list, key=lambda x:len(x.split('.')), reverse=True):
-            if src_name is None or item != src_name:
-                if name == item:
+        if isinstance(avail_list, (list, tuple)):
+            avail_list = set(avail_list)
+
+        end = len(name)
+        while end >= 0:
+            item = name[:end]
+            if item in avail_list and (src_name is None or item != src_name):
+                if end == len(name):
                     return item, None
-                
-                elif name.startswith(f'{item}.'):
-                    return item, name[len(item)+1:]
+                else:
+                    return item, name[end+1:]
+            
+            end = name.rfind('.', 0, end)
         
         return None
 
 
     def is_local_import(self, fpath, imported_info):
         '''
-        Judge if module.name is imported from current project
+        Judge if module.name is imported from current project (memoized)
         '''
+        key = (self.proj_dir, fpath, imported_info[0], imported_info[1])
+        if key in self.import_cache:
+            self.import_cache_hits += 1
+            self.import_cache.move_to_end(key)
+            ret = self.import_cache[key]
+        else:
+            self.import_cache_misses += 1
+            ret = self._is_local_import(fpath, imported_info)
+            self.import_cache[key] = ret
+            if len(self.import_cache) > self.import_cache_size:
+                self.import_cache.popitem(last=False)
+        
+        if ret is None:
+            return None
+        else:
+            return list(ret)
+
+
+    def _is_local_import(self, fpath, imported_info):
         module, name = imported_info
 
         if name is not None:
@@ -79,6 +161,26 @@ class projectSearcher(object):
         return src_len + target_len - 2 * equal_len
 
 
+    def _get_candidate_modules(self, fpath, module):
+        '''
+        The modules that are or end with module, sorted by the distance to fpath
+        '''
+        key = (module, fpath)
+        candidates_modules = self.candidates_cache.get(key, None)
+        if candidates_modules is None:
+            candidates_modules = self.suffix_index.get(module, [])
+            if len(candidates_modules) > 1:
+                # sort by distance
+                candidates_modules = sorted(candidates_modules, key=lambda x:self.get_distance_fpaths(x, fpath))
+            self.candidates_cache[key] = candidates_modules
+        
+        if self.proj_info is self.index_base:
+            return candidates_modules
+        else:
+            # the view hides some modules
+            return [x for x in candidates_modules if x in self.proj_info]
+
+
     def _check_local_import(self, fpath, imported_info):
         '''
         Judge if module.name is imported from current project
@@ -94,18 +196,13 @@ class projectSearcher(object):
                 # Python standard module
                 return None
         
-        candidates_modules = [x for x in self.proj_info if x == module or x.endswith('.'+module)]
-        nums = len(candidates_modules)
-        if nums > 0:
-            if nums > 1:
-                # sort by distance
-                candidates_modules.sort(key=lambda x:self.get_distance_fpaths(x, fpath))
-            
+        candidates_modules = self._get_candidate_modules(fpath, module)
+        if len(candidates_modules) > 0:
             for item in candidates_modules:
                 if name is None:
                     return [item, name]
                 else:
-                    find_info = self.name_in_file(name, list(self.proj_info[item]))
+                    find_info = self.name_in_file(name, self.proj_info[item])
                     if find_info is not None:
                         return [item, find_info[0]]
         
@@ -367,61 +464,40 @@ class projectSearcher(object):
         '''
         file_edges: {fpath: [fpath]}
         fpath_order: reversed, significance decreases progressively
+
+        Kahn's algorithm with a heap, the fpath with the minimum in degree is taken even in a cycle
+        Ties are broken by fpath_order (fpaths not in it first, by string), the same as a scan of all fpaths
         '''
-        in_table = {}
+        order_index = {}
+        for i, item in enumerate(fpath_order):
+            order_index.setdefault(item, i)
+
+        in_degree = {item: 0 for item in fpath_set}
         out_table = {}
         for item in fpath_set:
-            if item not in in_table:
-                in_table[item] = []
-            if item not in out_table:
-                out_table[item] = []
-
-            for x in file_edges.get(item, []):
-                if x not in fpath_set:
-                    continue
-
-                out_table[item].append(x)
-                if x not in in_table:
-                    in_table[x] = [item]
-                else:
-                    in_table[x].append(item)
+            out_table[item] = [x for x in file_edges.get(item, []) if x in fpath_set]
+            for x in out_table[item]:
+                in_degree[x] += 1
+        
+        # the most significant fpath in topo order
+        sort_key = {item: (0, item) if item not in order_index else (1, order_index[item]) for item in fpath_set}
+        heap = [(in_degree[item], sort_key[item], item) for item in fpath_set]
+        heapq.heapify(heap)
 
         sort_list = []
-        while len(in_table) > 0:
-            node_list = list(in_table)
-
-            # choice the most significant fpath in topo order
-            min_index = 0
-            min_degree = len(in_table[node_list[min_index]])
-            for i in range(1, len(node_list)):
-                item = node_list[i]
-
-                in_degree = len(in_table[item])
-                if in_degree < min_degree:
-                    # in degree
-                    min_index = i
-                    min_degree = in_degree
-                elif in_degree == min_degree:
-                    if node_list[min_index] in fpath_order and item in fpath_order:
-                        # keep to the order
-                        if fpath_order.index(item) < fpath_order.index(node_list[min_index]):
-                            min_index = i
-                    elif node_list[min_index] not in fpath_order and item not in fpath_order:
-                        # compare string
-                        if item < node_list[min_index]:
-                            min_index = i
-                    else:
-                        if item not in fpath_order:
-                            min_index = i
+        removed = set()
+        while heap:
+            degree, _, item = heapq.heappop(heap)
+            # outdated in degree
+            if item in removed or degree != in_degree[item]:
+                continue
             
-            item = node_list[min_index]
+            removed.add(item)
             sort_list.append(item)
-
-            for x in out_table.pop(item):
-                in_table[x].remove(item)
-            
-            for x in in_table.pop(item):
-                out_table[x].remove(item)
+            for x in out_table[item]:
+                if x not in removed:
+                    in_degree[x] -= 1
+                    heapq.heappush(heap, (in_degree[x], sort_key[x], x))
         
         sort_list = list(reversed(sort_list))
         
@@ -510,4 +586,159 @@ class projectSearcher(object):
             prompt_list.append(self.get_prompt4names(fpath, node_dict[fpath], only_def, enable_docstring))
         
         # replece the docsting
-        return '\n\n'.join(prompt_list).replace("'''", '"""')
\ No newline at end of file
+        return '\n\n'.join(prompt_list).replace("'''", '"""')
+
+
+class promptBuilder(object):
+    '''
+    Incremental version of projectSearcher.get_prompt for node lists that grow step by step
+    The DFS closure of each node and the snippet of each (fpath, names) are computed once,
+    only the snippets of changed files are rendered again, and the files are sorted again only if their order may change
+    If tokenizer is given, the token numbers of the snippets are summed up in self.tokens as they change
+    '''
+    def __init__(self, searcher, max_hop=None, only_def=True, enable_docstring=True, tokenizer=None):
+        self.searcher = searcher
+        self.max_hop = max_hop
+        self.only_def = only_def
+        self.enable_docstring = enable_docstring
+        self.tokenizer = tokenizer
+
+        # {(fpath, name): (node_dict, file_edges)}
+        self.closure_cache = {}
+        # {(fpath, frozenset(names)): snippet}
+        self.snippet_cache = {}
+
+        self.reset()
+    
+
+    def reset(self):
+        self.node_list = []
+        self.nodes = set()
+        self.node_dict = {}     # {fpath: set(name)}
+        self.file_edges = {}    # {fpath: [fpath]}
+        self.fpath_order = []   # fpaths in the order of node_list
+
+        self.sorted_files = []
+        self.file_snippets = {} # {fpath: snippet}
+        self.file_tokens = {}   # {fpath: token number of snippet}
+        # None without tokenizer
+        self.tokens = 0 if self.tokenizer is not None else None
+
+        # files whose names changed, and whether the files need to be sorted again
+        self.changed_files = set()
+        self.order_changed = False
+
+        self.prompt = ''
+        self.snippets = []
+
+
+    def add(self, node):
+        '''
+        Merge the DFS closure of node (fpath, name)
+        '''
+        if node in self.nodes:
+            return
+
+        self.nodes.add(node)
+        if node not in self.closure_cache:
+            self.closure_cache[node] = self.searcher.depthFirstSearch(node[0], node[1], self.max_hop)
+        tmp_nodes, tmp_edges = self.closure_cache[node]
+
+        for k, v in tmp_nodes.items():
+            if k not in self.node_dict:
+                self.node_dict[k] = set(v)
+                self.changed_files.add(k)
+                self.order_changed = True
+            elif not self.node_dict[k].issuperset(v):
+                self.node_dict[k].update(v)
+                self.changed_files.add(k)
+        
+        for k, v in tmp_edges.items():
+            if k not in self.file_edges:
+                self.file_edges[k] = list(v)
+            else:
+                self.file_edges[k].extend(v)
+            # repeated edges count in the in degrees as well
+            if v:
+                self.order_changed = True
+
+
+    def _get_snippet(self, fpath):
+        key = (fpath, frozenset(self.node_dict[fpath]))
+        if key not in self.snippet_cache:
+            snippet = self.searcher.get_prompt4names(fpath, self.node_dict[fpath], self.only_def, self.enable_docstring)
+            # replece the docsting
+            self.snippet_cache[key] = snippet.replace("'''", '"""')
+        return self.snippet_cache[key]
+
+
+    def _render(self):
+        if self.order_changed:
+            self.sorted_files = self.searcher.pseudo_topo_sort(set(self.node_dict), self.file_edges, self.fpath_order)
+
+        for fpath in self.changed_files:
+            snippet = self._get_snippet(fpath)
+            self.file_snippets[fpath] = snippet
+            if self.tokenizer is not None:
+                tokens = self.tokenizer.cal_snippet_tokens(snippet)
+                self.tokens += tokens - self.file_tokens.get(fpath, 0)
+                self.file_tokens[fpath] = tokens
+        
+        if self.order_changed or self.changed_files:
+            self.snippets = [self.file_snippets[fpath] for fpath in self.sorted_files]
+            self.prompt = '\n\n'.join(self.snippets)
+        
+        self.changed_files = set()
+        self.order_changed = False
+
+        return self.prompt, self.snippets
+
+
+    def build(self, node_list):
+        '''
+        Same as projectSearcher.get_prompt(node_list)
+        Return: prompt, [snippet of each file]
+        '''
+        node_list = list(node_list)
+        if node_list == self.node_list:
+            return self.prompt, self.snippets
+
+        if not self.nodes.issubset(node_list):
+            # not a growing list
+            self.reset()
+
+        fpath_order = []
+        for node in node_list:
+            if node[0] not in fpath_order:
+                fpath_order.append(node[0])
+            self.add(node)
+        
+        if fpath_order != self.fpath_order:
+            self.fpath_order = fpath_order
+            self.order_changed = True
+        self.node_list = node_list
+
+        return self._render()
+
+
+    def insert(self, index, node):
+        '''
+        Same as build with node inserted at index of the current node list,
+        node is not in node_list[:index], and it is moved to index if it is in the rest
+        Return: prompt, [snippet of each file]
+        '''
+        head = {x[0] for x in self.node_list[:index]}
+        if node in self.nodes:
+            self.node_list.remove(node)
+        else:
+            self.add(node)
+        self.node_list.insert(index, node)
+
+        # fpath_order[:len(head)] is the order of head
+        if node[0] not in head and self.fpath_order[len(head):len(head)+1] != [node[0]]:
+            if node[0] in self.fpath_order:
+                self.fpath_order.remove(node[0])
+            self.fpath_order.insert(len(head), node[0])
+            self.order_changed = True
+        
+        return self._render()
@@ -1,13 +1,34 @@
 import os
 import re
 import json
+import hashlib
+from multiprocessing import Pool
+from argparse import ArgumentParser
 from pyfile_parse import PythonParser
 from node_prompt import projectSearcher
-from utils import DS_REPO_DIR, DS_FILE, DS_GRAPH_DIR
+from context_graph import LazyContextGraph, dump_context_graph, load_context_graph
+from utils import DS_REPO_DIR, DS_FILE, DS_GRAPH_DIR, PARALLEL_THRESHOLD
+
+
+# each process of the file pool owns a parser
+_file_parser = None
+
+def _init_file_worker():
+    global _file_parser
+    _file_parser = PythonParser()
+
+
+def _parse_file_worker(fpath):
+    return fpath, _file_parser.parse(fpath)
+
 
 
 class projectParser(object):
-    def __init__(self):
+    def __init__(self, workers=1, parallel_threshold=PARALLEL_THRESHOLD):
+        '''
+        workers: number of processes for parsing the files of a repository
+        parallel_threshold: repositories with fewer files are parsed serially
+        '''
         self.py_parser = PythonParser()
         self.iden_pattern = re.compile(r'[^\w\-]')
 
@@ -15,8 +36,35 @@ class projectParser(object):
 
         self.proj_dir = None
         self.parse_res = None
+        # {"proj_dir": str, "files": {relative path: {"module", "mtime", "size", "sha1"}}}
+        self.manifest = None
+
+        self.workers = workers
+        self.parallel_threshold = parallel_threshold
+        self.pool = None
     
 
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+    def parse_files(self, fpath_list):
+        '''
+        Return: {fpath: info of the file}
+        '''
+        if self.workers <= 1 or len(fpath_list) < self.parallel_threshold:
+            return {fpath: self.py_parser.parse(fpath) for fpath in fpath_list}
+
+        if self.pool is None:
+            self.pool = Pool(self.workers, initializer=_init_file_worker)
+
+        chunksize = max(1, len(fpath_list) // (4 * self.workers))
+        return dict(self.pool.imap_unordered(_parse_file_worker, fpath_list, chunksize))
+
+
     def set_proj_dir(self, dir_path):
         if not dir_path.endswith(os.sep):
             self.proj_dir = dir_path + os.sep
@@ -24,11 +72,18 @@ class projectParser(object):
             self.proj_dir = dir_path
 
 
-    def retain_project_rels(self):
+    def retain_project_rels(self, modules=None):
         '''
         retain the useful relationships
+        modules: only connect these modules (default: all)
         '''
-        for module, file_info in self.parse_res.items():
+        if modules is None:
+            modules = list(self.parse_res)
+
+        for module in modules:
+            file_info = self.parse_res[module]
+            # {(module, name): resolved import}
+            resolved_imports = {}
             for name, info_dict in file_info.items():
                 cls = info_dict.get("in_class", None)
 
@@ -38,7 +93,7 @@ class projectParser(object):
                     del_index = []
                     for i, item in enumerate(rels):
                         # item: [name, type]
-                        find_info = self.proj_searcher.name_in_file(item[0], list(file_info), name, cls)
+                        find_info = self.proj_searcher.name_in_file(item[0], file_info, name, cls)
                         if find_info is None:
                             del_index.append(i)
                         else:
@@ -56,10 +111,15 @@ class projectParser(object):
                 imported_info = info_dict.get("import", None)
                 if info_dict["type"] == 'Variable' and imported_info is not None:
                     judge_res = self.proj_searcher.is_local_import(module, imported_info)
+                    resolved_imports[tuple(imported_info)] = judge_res
                     if judge_res is None:
                         info_dict.pop("import")
                     else:
                         info_dict["import"] = judge_res
+            
+            # resolved import statements of the module, which are looked up in code completion
+            if '' in file_info and len(resolved_imports) > 0:
+                file_info['']["resolved_imports"] = [[k[0], k[1], v] for k, v in resolved_imports.items()]
 
 
 
@@ -107,13 +167,149 @@ class projectParser(object):
                 "in_class": str (optional),
                 "in_init": bool (optional),
                 "rels": [[name:str, suffix:str, type:str], ],    # type: "Assign", "Hint", "Rhint", "Inherit"
-                "import": [module:str, name:str]     # "Import"
+                "import": [module:str, name:str],    # "Import"
+                "resolved_imports": [[module:str, name:str, [module:str, name:str] or None], ] (only for "")
             }
             }}
         '''
         self.set_proj_dir(pkg_dir)
         py_dict = self._get_all_module_path(pkg_dir)
+        module_dict = self._get_module_dict(py_dict)
+
+        parse_list = self._get_parse_list(module_dict, py_dict)
+        parsed_files = self.parse_files(parse_list)
+
+        self.manifest = {"proj_dir": self.proj_dir, "files": {}}
+        for fpath in parse_list:
+            self.manifest["files"][fpath[len(self.proj_dir):]] = self._get_file_entry(fpath)
+
+        self.parse_res = self._merge_modules(module_dict, py_dict, parsed_files)
+
+        self.proj_searcher.set_proj(pkg_dir, self.parse_res)
+        # connect the files
+        self.retain_project_rels()
+
+        return self.parse_res
+
+
+    def update_dir(self, pkg_dir, proj_info, manifest):
+        '''
+        Incremental version of parse_dir
+        proj_info: the previous result of parse_dir
+        manifest: the previous self.manifest
+        Only the modules that may be affected by the changed, added or deleted pyfiles are parsed and connected again,
+        the others are taken from proj_info
+        '''
+        self.set_proj_dir(pkg_dir)
+        if manifest is None or proj_info is None or manifest.get("proj_dir", None) != self.proj_dir:
+            return self.parse_dir(pkg_dir)
+
+        py_dict = self._get_all_module_path(pkg_dir)
+        module_dict = self._get_module_dict(py_dict)
+        parse_list = self._get_parse_list(module_dict, py_dict)
+
+        old_files = manifest["files"]
+        files = {}
+        changed_list = []
+        for fpath in parse_list:
+            rel_path = fpath[len(self.proj_dir):]
+            entry = old_files.get(rel_path, None)
+            if entry is None:
+                # added
+                changed_list.append(fpath)
+                continue
+
+            stat = os.stat(fpath)
+            if entry["mtime"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+                files[rel_path] = entry
+            elif entry["sha1"] == self._hash_file(fpath):
+                # touched, but the content is unchanged
+                files[rel_path] = dict(entry, mtime=stat.st_mtime_ns, size=stat.st_size)
+            else:
+                changed_list.append(fpath)
+
+        # modules with changed, added or deleted pyfiles
+        dirty_modules = set()
+        for fpath in changed_list:
+            files[fpath[len(self.proj_dir):]] = self._get_file_entry(fpath)
+            dirty_modules.add(self._get_module_name(fpath))
+        
+        for rel_path, entry in old_files.items():
+            if rel_path not in files:
+                dirty_modules.add(entry["module"])
+        
+        self.manifest = {"proj_dir": self.proj_dir, "files": files}
+
+        # modules whose names are changed, e.g., a submodule is added to the dir
+        submodule_dict = {}
+        for module, path_list in module_dict.items():
+            submodules = self._get_submodules(module, path_list, py_dict)
+            # modules without submodules or pyfiles are not in the result
+            if len(submodules) > 0 or any(fpath not in py_dict for fpath in path_list):
+                submodule_dict[module] = submodules
+        
+        for module in set(submodule_dict) | set(proj_info):
+            if module not in submodule_dict or module not in proj_info:
+                dirty_modules.add(module)
+            elif submodule_dict[module] != [k for k, v in proj_info[module].items() if k and v["type"] == 'Module']:
+                dirty_modules.add(module)
+
+        # the imports of other modules can only be resolved to a dirty module if they contain its last component
+        dirty_names = set([x.split('.')[-1] for x in dirty_modules])
+        affected_modules = []
+        for module in submodule_dict:
+            if module in dirty_modules:
+                affected_modules.append(module)
+                continue
+
+            # the import statements of the module before they are resolved
+            for module_name, name, _ in proj_info[module].get('', {}).get("resolved_imports", []):
+                components = set(module_name.split('.'))
+                if name is not None:
+                    components.update(name.split('.'))
+                
+                if len(components & dirty_names) > 0:
+                    affected_modules.append(module)
+                    break
         
+        # the affected modules are parsed and connected again, and the others are taken from proj_info
+        affected_dict = {module: module_dict[module] for module in affected_modules}
+        parsed_files = self.parse_files(self._get_parse_list(affected_dict, py_dict))
+        affected_res = self._merge_modules(affected_dict, py_dict, parsed_files)
+
+        self.parse_res = {}
+        for module in submodule_dict:
+            if module in affected_dict:
+                self.parse_res[module] = affected_res[module]
+            else:
+                self.parse_res[module] = proj_info[module]
+
+        self.proj_searcher.set_proj(pkg_dir, self.parse_res)
+        # connect the affected files
+        self.retain_project_rels(affected_modules)
+
+        return self.parse_res
+
+
+    def _hash_file(self, fpath):
+        with open(fpath, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+
+    def _get_file_entry(self, fpath):
+        stat = os.stat(fpath)
+        return {
+            "module": self._get_module_name(fpath),
+            "mtime": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "sha1": self._hash_file(fpath)
+        }
+
+
+    def _get_module_dict(self, py_dict):
+        '''
+        Return: {module: [dir, __init__.py, .py]}
+        '''
         # order: dir, __init__.py, .py
         module_dict = {}
         # dir
@@ -122,18 +318,18 @@ class projectParser(object):
             if len(module) > 0:
                 module_dict[module] = [dir_path,]
         
-        # pyfiles
+        # pyfiles (sorted, so that the graph does not depend on the hash seed of the process)
         init_files = set()
         pyfiles = set()
         for py_set in py_dict.values():
-            for fpath in py_set:
+            for fpath in sorted(py_set):
                 if fpath.endswith(os.sep + '__init__.py'):
                     init_files.add(fpath)
                 else:
                     pyfiles.add(fpath)
         
         # __init__.py
-        for fpath in init_files:
+        for fpath in sorted(init_files):
             module = self._get_module_name(fpath)
             if len(module) > 0:
                 if module in module_dict:
@@ -142,7 +338,7 @@ class projectParser(object):
                     module_dict[module] = [fpath,]
         
         # .py
-        for fpath in pyfiles:
+        for fpath in sorted(pyfiles):
             module = self._get_module_name(fpath)
             if len(module) > 0:
                 if module in module_dict:
@@ -150,65 +346,151 @@ class projectParser(object):
                 else:
                     module_dict[module] = [fpath,]
         
-        self.parse_res = {}
+        return module_dict
+
+
+    def _get_parse_list(self, module_dict, py_dict):
+        # the first pyfile of each module
+        parse_list = []
+        for path_list in module_dict.values():
+            for fpath in path_list:
+                if fpath not in py_dict:
+                    parse_list.append(fpath)
+                    break
+        
+        return parse_list
+
+
+    def _get_submodules(self, module, path_list, py_dict):
+        '''
+        Return: [submodule] in the dir of module, which are recorded before the info of its pyfile
+        '''
+        submodules = {}
+        if path_list[0] in py_dict:
+            for item in sorted(py_dict[path_list[0]]):
+                submodule = self._get_module_name(item)
+                if submodule != module:
+                    # exclude __init__.py
+                    submodules[submodule] = None
+        
+        return list(submodules)
+
+
+    def _merge_modules(self, module_dict, py_dict, parsed_files):
+        parse_res = {}
         for module, path_list in module_dict.items():
             info_dict = {}
+            for submodule in self._get_submodules(module, path_list, py_dict):
+                info_dict[submodule] = {
+                    "type": "Module",
+                    "import": [submodule, None]
+                }
+            
+            # pyfiles
             for fpath in path_list:
-                if fpath in py_dict:
-                    # dir
-                    for item in py_dict[fpath]:
-                        submodule = self._get_module_name(item)
-                        if submodule != module:
-                            # exclude __init__.py
-                            info_dict[submodule] = {
-                                "type": "Module",
-                                "import": [submodule, None]
-                            }
-                else:
-                    # pyfiles
-                    info_dict.update(self.py_parser.parse(fpath))
+                if fpath not in py_dict:
+                    info_dict.update(parsed_files[fpath])
                     break
             
             if len(info_dict) > 0:
-                self.parse_res[module] = info_dict
+                parse_res[module] = info_dict
+        
+        return parse_res
 
-        self.proj_searcher.set_proj(pkg_dir, self.parse_res)
-        # connect the files
-        self.retain_project_rels()
 
-        return self.parse_res
+
+def get_pkg_dir(dir_path):
+    content = list(os.listdir(dir_path))
+    if len(content) > 1:
+        return dir_path
+    else:
+        # package/package-version/
+        return os.path.join(dir_path, content[0])
+
+
+def build_graph(item, project_parser, incremental=False, graph_format='json'):
+    '''
+    Build the repo-specific context graph of DS_REPO_DIR/item and save it to DS_GRAPH_DIR/item.json (or item.bin)
+    incremental: only update the changed files of an existing graph, based on DS_GRAPH_DIR/item.manifest
+    graph_format: 'json' or 'bin' (see context_graph.py)
+    '''
+    dir_path = os.path.join(DS_REPO_DIR, item)
+    graph_file = os.path.join(DS_GRAPH_DIR, f'{item}.{graph_format}')
+    manifest_file = os.path.join(DS_GRAPH_DIR, f'{item}.manifest')
+
+    if incremental and os.path.isfile(graph_file) and os.path.isfile(manifest_file):
+        proj_info = load_context_graph(graph_file)
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+        info = project_parser.update_dir(get_pkg_dir(dir_path), proj_info, manifest)
+        if isinstance(proj_info, LazyContextGraph):
+            proj_info.close()
+    else:
+        info = project_parser.parse_dir(get_pkg_dir(dir_path))
+
+    if graph_format == 'bin':
+        dump_context_graph(info, graph_file)
+    else:
+        with open(graph_file, 'w') as f:
+            json.dump(info, f)
+    
+    # the graph of the other format is out of date, and it is preferred by the loader when it is .bin
+    other_file = os.path.join(DS_GRAPH_DIR, f'{item}.{"json" if graph_format == "bin" else "bin"}')
+    if os.path.isfile(other_file):
+        os.remove(other_file)
+
+    with open(manifest_file, 'w') as f:
+        json.dump(project_parser.manifest, f)
+    
+    return item
+
+
+# each worker process owns a parser
+_worker_parser = None
+_worker_incremental = False
+_worker_format = 'json'
+
+def _init_worker(incremental, graph_format):
+    global _worker_parser, _worker_incremental, _worker_format
+    _worker_parser = projectParser()
+    _worker_incremental = incremental
+    _worker_format = graph_format
+
+
+def _build_graph_worker(item):
+    return build_graph(item, _worker_parser, _worker_incremental, _worker_format)
 
 
 
 if __name__ == '__main__':
 
+    parser = ArgumentParser()
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of processes for preprocessing')
+    parser.add_argument('-fw', '--file_workers', type=int, default=1, help='number of processes for parsing the files of a large repository (serial mode only)')
+    parser.add_argument('-i', '--incremental', action='store_true', help='only re-parse the changed files of existing graphs')
+    parser.add_argument('--format', default='json', choices=['json', 'bin'], help='json, or the binary format that is loaded lazily')
+    args = parser.parse_args()
+
     with open(DS_FILE, 'r') as f:
         ds = [json.loads(line) for line in f.readlines()]
     
     pkg_set = set([x['pkg'] for x in ds])
     print(f'There are {len(pkg_set)} repositories in ReccEval.')
 
-    project_parser = projectParser()
-
     if not os.path.isdir(DS_GRAPH_DIR):
         os.mkdir(DS_GRAPH_DIR)
 
-    for item in os.listdir(DS_REPO_DIR):
-        if item not in pkg_set:
-            continue
-        
-        dir_path = os.path.join(DS_REPO_DIR, item)
-        if os.path.isdir(dir_path):
-            
-            content = list(os.listdir(dir_path))
-            if len(content) > 1:
-                info = project_parser.parse_dir(dir_path)
-            else:
-                # package/package-version/
-                dist_path = os.path.join(dir_path, content[0])
-                info = project_parser.parse_dir(dist_path)
+    pkg_list = [x for x in sorted(os.listdir(DS_REPO_DIR)) if x in pkg_set and os.path.isdir(os.path.join(DS_REPO_DIR, x))]
 
-            with open(os.path.join(DS_GRAPH_DIR, f'{item}.json'), 'w') as f:
-                json.dump(info, f)
+    if args.workers > 1:
+        with Pool(args.workers, initializer=_init_worker, initargs=(args.incremental, args.format)) as pool:
+            for i, item in enumerate(pool.imap_unordered(_build_graph_worker, pkg_list)):
+                print(f'[{i+1}/{len(pkg_list)}] {item}', flush=True)
+    else:
+        project_parser = projectParser(workers=args.file_workers)
+        for i, item in enumerate(pkg_list):
+            build_graph(item, project_parser, args.incremental, args.format)
+            print(f'[{i+1}/{len(pkg_list)}] {item}', flush=True)
+        project_parser.close()
     
-    print(f'Generate repo-specific context graph for {len(os.listdir(DS_GRAPH_DIR))} repositories.')
\ No newline at end of file
+    print(f'Generate repo-specific context graph for {len([x for x in os.listdir(DS_GRAPH_DIR) if x.endswith(".json") or x.endswith(".bin")])} repositories.')
@@ -0,0 +1,129 @@
+import json
+import time
+from contextlib import contextmanager
+
+
+class _nullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_SPAN = _nullSpan()
+
+
+class stageProfiler(object):
+    def __init__(self, enabled=False):
+        '''
+        Latency of the stages and counters of one run, e.g., the retrieval of all samples
+        Stages out of request() are recorded per span
+        When disabled, span() returns a shared no-op context and count() returns at once
+        '''
+        self.enabled = enabled
+        self.reset()
+
+
+    def reset(self):
+        # {stage: [seconds]}
+        self.durations = {}
+        # {counter: number}
+        self.counters = {}
+        # {stage: seconds} of the current request
+        self.current = None
+
+
+    def span(self, stage):
+        if not self.enabled:
+            return _NULL_SPAN
+        return self._span(stage)
+
+
+    @contextmanager
+    def _span(self, stage):
+        start_time = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add(stage, time.perf_counter() - start_time)
+
+
+    def request(self):
+        '''
+        The spans in a request are summed up, so that the durations are the latency of each stage per request
+        '''
+        if not self.enabled or self.current is not None:
+            return _NULL_SPAN
+        return self._request()
+
+
+    @contextmanager
+    def _request(self):
+        self.current = {}
+        start_time = time.perf_counter()
+        try:
+            yield self
+        finally:
+            current = self.current
+            self.current = None
+            for stage, seconds in current.items():
+                self.add(stage, seconds)
+            self.add('total', time.perf_counter() - start_time)
+            self.count('requests')
+
+
+    def add(self, stage, seconds):
+        if self.current is not None:
+            self.current[stage] = self.current.get(stage, 0) + seconds
+        elif stage not in self.durations:
+            self.durations[stage] = [seconds]
+        else:
+            self.durations[stage].append(seconds)
+
+
+    def count(self, counter, num=1):
+        if not self.enabled:
+            return
+        self.counters[counter] = self.counters.get(counter, 0) + num
+
+
+    def merge(self, other):
+        '''
+        Add the durations and counters of other, e.g., from another process
+        '''
+        for stage, values in other.durations.items():
+            self.durations.setdefault(stage, []).extend(values)
+        for counter, num in other.counters.items():
+            self.counters[counter] = self.counters.get(counter, 0) + num
+
+
+    @staticmethod
+    def _percentile(sorted_values, p):
+        '''
+        nearest-rank percentile
+        '''
+        k = max(0, min(len(sorted_values) - 1, int(-(-p * len(sorted_values) // 100)) - 1))
+        return sorted_values[k]
+
+
+    def summary(self):
+        stages = {}
+        for stage, values in self.durations.items():
+            values = sorted(values)
+            stages[stage] = {
+                "count": len(values),
+                "total": sum(values),
+                "mean": sum(values) / len(values),
+                "p50": self._percentile(values, 50),
+                "p95": self._percentile(values, 95),
+                "p99": self._percentile(values, 99),
+                "max": values[-1]
+            }
+
+        return {"stages": stages, "counters": dict(self.counters)}
+
+
+    def dump(self, fpath):
+        with open(fpath, 'w') as f:
+            json.dump(self.summary(), f, indent=4)
@@ -135,7 +135,7 @@ class astVisiter(object):
 
         self._get_main_type(node, type_set, related_set)
 
-        return type_set, related_set
+        return sorted(type_set), sorted(related_set)
 
 
     def _get_superclasses(self, node):
@@ -164,7 +164,7 @@ class astVisiter(object):
                 if attr is not None:
                     ret.add(attr)
         
-        return ret
+        return sorted(ret)
 
     
     def _get_assignment_info(self, node, cls=None, in_init=False):
@@ -555,7 +555,7 @@ class astVisiter(object):
             if name:
                 ret.add(name)
 
-        return ret
+        return sorted(ret)
 
 
     def _get_primary_expression(self, node):
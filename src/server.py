@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import time
+import asyncio
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+from generator import Generator as promptGenerator
+from utils import DS_REPO_DIR, DS_GRAPH_DIR
+from argparse import ArgumentParser
+
+
+'''
+Completion server: one JSON object per line
+request:  {"id": any, "pkg": str, "fpath": str (relative to the repository directory), "input": str}
+response: {"id": any, "prompt": str, "latency": seconds from receiving to answering, "time": seconds of retrieval}
+          {"id": any, "error": str, "latency": float} if the prompt cannot be retrieved
+'''
+
+
+class promptServer(object):
+    def __init__(self, generator, proj_dir):
+        '''
+        The generator (with its tokenizer and graphs) is kept warm between requests
+        Generator is not thread-safe, so requests are retrieved one at a time in a worker thread,
+        while the event loop keeps reading and answering the clients
+        '''
+        self.generator = generator
+        self.proj_dir = os.path.abspath(proj_dir)
+        # a single worker, so that requests are retrieved one at a time
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+
+    def _retrieve(self, item):
+        start_time = time.time()
+        fpath = os.path.join(self.proj_dir, item['fpath'])
+        # same as generator.retrieve_prompt, but the file is set only once
+        with self.generator.profiler.request():
+            self.generator.set_pyfile(item['pkg'], fpath)
+            if self.generator.project != item['pkg']:
+                raise KeyError(f'Unknown package {item["pkg"]}')
+            prompt = self.generator._retrieve_prompt(self.generator._get_module_name(fpath), item['input'])
+        return prompt, time.time() - start_time
+
+
+    async def handle(self, line):
+        start_time = time.time()
+        item = {}
+        try:
+            item = json.loads(line)
+            prompt, cost = await asyncio.get_running_loop().run_in_executor(self.executor, self._retrieve, item)
+        except Exception as e:
+            ret = {"error": repr(e)}
+        else:
+            ret = {"prompt": prompt, "time": cost}
+
+        ret["id"] = item.get("id", None) if isinstance(item, dict) else None
+        ret["latency"] = time.time() - start_time
+        return json.dumps(ret) + '\n'
+
+
+    async def serve_stdio(self, out):
+        '''
+        Read requests from stdin and write responses to out, in the order they are answered
+        '''
+        loop = asyncio.get_running_loop()
+        tasks = set()
+
+        async def answer(line):
+            out.write(await self.handle(line))
+            out.flush()
+
+        while True:
+            line = await loop.run_in_executor(None, sys.stdin.readline)
+            if not line:
+                break
+            if not line.strip():
+                continue
+            task = asyncio.create_task(answer(line))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.gather(*tasks)
+
+
+    async def _serve_client(self, reader, writer):
+        tasks = set()
+
+        async def answer(line):
+            writer.write((await self.handle(line)).encode())
+            await writer.drain()
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            task = asyncio.create_task(answer(line))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.gather(*tasks)
+        writer.close()
+
+
+    async def serve_unix(self, socket_path):
+        server = await asyncio.start_unix_server(self._serve_client, path=socket_path, limit=2**26)
+        print(f'Listening on {socket_path}', file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument('-m', '--model', required=True, help='Code LMs, incl. codegen, codegen25, santacoder, starcoder, codellama, gpt35, gpt4')
+    parser.add_argument('-s', '--socket', default=None, help='listen on a unix socket instead of stdin/stdout')
+    parser.add_argument('--proj_dir', default=DS_REPO_DIR, help='directory of the repositories')
+    parser.add_argument('--graph_dir', default=DS_GRAPH_DIR, help='directory of the repo-specific context graphs')
+    parser.add_argument('--prewarm', nargs='*', default=[], help='packages whose graphs are loaded at startup')
+    args = parser.parse_args()
+
+    out = sys.stdout
+    # the responses own stdout, other messages go to stderr
+    with redirect_stdout(sys.stderr):
+        generator = promptGenerator(args.proj_dir, args.graph_dir, args.model.lower(), prewarm=args.prewarm)
+        server = promptServer(generator, args.proj_dir)
+        print('Server is ready.')
+
+        if args.socket:
+            asyncio.run(server.serve_unix(args.socket))
+        else:
+            asyncio.run(server.serve_stdio(out))
@@ -1,21 +1,40 @@
 import os
 import yaml
-
-from transformers import AutoTokenizer
-import torch
+import hashlib
+from collections import OrderedDict
+
+try:
+    from transformers import AutoTokenizer
+    import torch
+except ImportError:
+    # only required by the Hugging Face models
+    AutoTokenizer = None
+    torch = None
 import tiktoken
 import attridict
 
 
 class ModelTokenizer:
-    def __init__(self, model):
+    # added to each boundary between snippets when the tokens are summed up
+    BOUNDARY_TOKENS = 2
+
+    def __init__(self, model, snippet_cache_size=65536):
         self.model = model
         self.config = attridict(yaml.load(open('config.yaml', 'r'), Loader=yaml.FullLoader))
 
         self._set_tokenizer()
+        # number of texts tokenized by cal_token_nums
+        self.token_calls = 0
+
+        # LRU cache: {(model, md5 of snippet): token number}
+        self.snippet_tokens = OrderedDict()
+        self.snippet_cache_size = snippet_cache_size
     
 
     def _set_tokenizer(self):
+        if not self.model.startswith('gpt') and AutoTokenizer is None:
+            raise ImportError(f'transformers and torch are required by the tokenizer of {self.model}')
+        
         if self.model == 'codegen':
             self.tokenizer = AutoTokenizer.from_pretrained(self.config.codegen350m_repo)
             self.max_input_length = self.config.codegen_max_token - self.config.max_to_generate
@@ -43,6 +62,7 @@ class ModelTokenizer:
     
 
     def cal_token_nums(self, text):
+        self.token_calls += 1
         if self.model.startswith('codegen') or self.model == 'codellama':
             return self.tokenizer(text, return_tensors="pt").attention_mask.sum()
         elif self.model.startswith('gpt'):
@@ -78,6 +98,47 @@ class ModelTokenizer:
         return self.cal_token_nums(prompt) <= max_length
 
 
+    def cal_snippet_tokens(self, snippet):
+        '''
+        Token number of snippet (cached)
+        '''
+        key = (self.model, hashlib.md5(snippet.encode('utf-8')).hexdigest())
+        if key in self.snippet_tokens:
+            self.snippet_tokens.move_to_end(key)
+            return self.snippet_tokens[key]
+        
+        token_nums = int(self.cal_token_nums(snippet))
+        self.snippet_tokens[key] = token_nums
+        if len(self.snippet_tokens) > self.snippet_cache_size:
+            self.snippet_tokens.popitem(last=False)
+        
+        return token_nums
+
+
+    def judge_snippets(self, snippets, max_length, snippet_tokens=None):
+        '''
+        Additive version of judge_prompt('\n\n'.join(snippets), max_length)
+        The tokens of the snippets are summed up with BOUNDARY_TOKENS for each boundary, which is a conservative estimate.
+        The prompt is tokenized only if the estimate is overlong.
+        snippet_tokens: sum of the token numbers of snippets if it is kept by the caller
+        '''
+        prefix = "'''\n"
+        if self.model.startswith('gpt'):
+            prefix = self.task_desc + prefix
+        
+        if snippet_tokens is None:
+            snippet_tokens = sum([self.cal_snippet_tokens(x) for x in snippets])
+        estimate = self.cal_snippet_tokens(prefix) + snippet_tokens
+        if len(snippets) > 1:
+            estimate += (len(snippets) - 1) * self.cal_snippet_tokens('\n\n')
+        estimate += len(snippets) * self.BOUNDARY_TOKENS
+
+        if estimate <= max_length:
+            return True
+        
+        return self.judge_prompt('\n\n'.join(snippets), max_length)
+
+
     def truncate_concat(self, program, prompt, suffix):
         truncated_prompt = None
         if self.model.startswith('codegen') or self.model == 'codellama':
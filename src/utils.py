@@ -6,6 +6,27 @@ ONLY_DEF = False
 ENABLE_DOCSTRING = True
 LAST_K_LINES = 1
 
+# how other imports are added to the prompt: 'linear' (one by one) or 'bisect' (galloping and binary search)
+BUDGET_SEARCH = 'linear'
+# sum up the cached token numbers of snippets in the budget checks of the bisect search, instead of tokenizing the whole prompt
+# (the linear search always keeps a running sum in promptBuilder)
+ADDITIVE_BUDGET = False
+
+# number of files whose last tree and DFG are kept for the next completion in the same file (0: disable)
+DFG_CACHE_SIZE = 64
+
+# memory budget of the project graphs kept by Generator, estimated as GRAPH_MEMORY_FACTOR * file size for .json graphs,
+# and LAZY_GRAPH_MEMORY_FACTOR * length of the decoded records for .bin graphs, which are decoded lazily
+GRAPH_CACHE_BYTES = 2 << 30
+GRAPH_MEMORY_FACTOR = 2
+LAZY_GRAPH_MEMORY_FACTOR = 16
+
+# record the latency of each stage in Generator.profiler
+PROFILE = False
+
+# repositories with fewer files are parsed in a single process during preprocessing
+PARALLEL_THRESHOLD = 200
+
 import os
 DS_BASE_DIR = os.path.abspath("../ReccEval")
 DS_REPO_DIR = os.path.join(DS_BASE_DIR, "Source_Code")